@@ -1,23 +1,63 @@
 import logging
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, \
-    InlineKeyboardButton, FSInputFile
+from datetime import datetime, timedelta, time, timezone
+from aiogram import Bot, Dispatcher, BaseMiddleware, Router, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, \
+    InlineKeyboardButton, FSInputFile, InputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, Index, func, text, \
+    and_, or_, tuple_, insert, select, literal, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.event import listens_for, listen
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import StaticPool
 import asyncio
+import csv
+import glob
+import hashlib
+import hmac
+import inspect
+import io
+import heapq
+import itertools
+import json
+import multiprocessing
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from calendar import monthrange
+from collections import OrderedDict
+from functools import lru_cache
 import random
 import os
+import threading
+import zlib
+from time import monotonic, perf_counter
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не обязателен: без него картинки мотивации не обрабатываются
+    Image = ImageOps = None
 
 # ===== Настройка бота =====
-logging.basicConfig(level=logging.INFO)
-bot = Bot(token="BOT_TOKEN")
-dp = Dispatcher()
+# Импорт модуля ничего не создает и не открывает: бот и подключение к БД создает create_app(),
+# поэтому тесты и бенчмарки могут импортировать модуль и собрать приложение со своими настройками
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Адрес собственного (или тестового) сервера Bot API, по умолчанию - api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL")
+bot = None  # Создается в create_app()
 
 # ===== Списки предметов и типов событий =====
 SUBJECTS = ["Математика", "Русский язык", "Биология", "География",
@@ -29,6 +69,9 @@ Base = declarative_base()
 
 class Homework(Base):
     __tablename__ = "homeworks"
+    __table_args__ = (
+        Index("ix_homeworks_user_done_deadline", "user_id", "is_done", "deadline"),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     subject = Column(String(100), nullable=False)
@@ -39,17 +82,1386 @@ class Homework(Base):
 
 class ScheduleEvent(Base):
     __tablename__ = "schedule_events"
+    __table_args__ = (
+        Index("ix_schedule_events_user_date", "user_id", "event_date"),
+        Index("ix_schedule_events_date", "event_date"),
+        Index("ix_schedule_events_pending_reminder", "event_date", sqlite_where=text("reminder_sent_at IS NULL")),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    subject = Column(String(100), nullable=False)
+    event_type = Column(String(50), nullable=False)
+    event_date = Column(DateTime, nullable=False)
+    description = Column(String(300))
+    created_at = Column(DateTime, default=datetime.now)
+    reminder_sent_at = Column(DateTime)
+
+class HomeworkArchive(Base):
+    """Давно выполненное задание, перенесенное из homeworks фоновым архивированием"""
+    __tablename__ = "homeworks_archive"
+    __table_args__ = (
+        Index("ix_homeworks_archive_user_deadline", "user_id", "deadline"),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    subject = Column(String(100), nullable=False)
+    task = Column(String(500), nullable=False)
+    deadline = Column(DateTime)
+    is_done = Column(Boolean, default=True)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+
+class ScheduleEventArchive(Base):
+    """Прошедшее событие, перенесенное из schedule_events фоновым архивированием"""
+    __tablename__ = "schedule_events_archive"
+    __table_args__ = (
+        Index("ix_schedule_events_archive_user_date", "user_id", "event_date"),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     subject = Column(String(100), nullable=False)
     event_type = Column(String(50), nullable=False)
     event_date = Column(DateTime, nullable=False)
     description = Column(String(300))
+    created_at = Column(DateTime)
+    reminder_sent_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False)
+
+class ListingVersion(Base):
+    """Версия заданий и событий пользователя: растет при каждом их изменении (см. ListingCache)"""
+    __tablename__ = "listing_versions"
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+class UserSettings(Base):
+    """Настройки пользователя: время ежедневной сводки и когда она последний раз отправлялась"""
+    __tablename__ = "user_settings"
+    user_id = Column(Integer, primary_key=True)
+    digest_time = Column(String(5))  # "ЧЧ:ММ" или None, если сводка выключена
+    digest_sent_at = Column(DateTime)
+
+class MediaFile(Base):
+    """Telegram file_id уже загруженного мотивационного файла"""
+    __tablename__ = "media_files"
+    path = Column(String(300), primary_key=True)
+    file_id = Column(String(200), nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class StoredMedia(Base):
+    """Мотивационный файл на диске, адресуемый по SHA-256 содержимого"""
+    __tablename__ = "stored_media"
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String(300), nullable=False)
+    size = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False, index=True)
     created_at = Column(DateTime, default=datetime.now)
+    normalized_at = Column(DateTime)  # Когда картинку обработал MediaPipeline
+
+class FSMRecord(Base):
+    """Состояние диалога пользователя (FSM) и его данные в JSON"""
+    __tablename__ = "fsm_states"
+    key = Column(String(200), primary_key=True)
+    state = Column(String(100))
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
+    version = Column(Integer, nullable=False, default=1)  # Растет при каждой записи (см. SQLiteStorage)
+
+class MediaAlias(Base):
+    """Соответствие file_unique_id из Telegram сохраненному файлу"""
+    __tablename__ = "media_aliases"
+    file_unique_id = Column(String(100), primary_key=True)
+    sha256 = Column(String(64), nullable=False)
+
+# ===== Миграции =====
+# Каждая миграция - список SQL-команд. Номер последней примененной миграции
+# хранится в PRAGMA user_version, поэтому существующие файлы БД обновляются на месте.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    # 1: исходная схема
+    [
+        """CREATE TABLE IF NOT EXISTS homeworks (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            subject VARCHAR(100) NOT NULL,
+            task VARCHAR(500) NOT NULL,
+            deadline DATETIME,
+            is_done BOOLEAN,
+            created_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS schedule_events (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            subject VARCHAR(100) NOT NULL,
+            event_type VARCHAR(50) NOT NULL,
+            event_date DATETIME NOT NULL,
+            description VARCHAR(300),
+            created_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+    ],
+    # 2: индексы под основные запросы
+    [
+        "CREATE INDEX IF NOT EXISTS ix_homeworks_user_done_deadline ON homeworks (user_id, is_done, deadline)",
+        "CREATE INDEX IF NOT EXISTS ix_schedule_events_user_date ON schedule_events (user_id, event_date)",
+        "CREATE INDEX IF NOT EXISTS ix_schedule_events_date ON schedule_events (event_date)",
+        "ANALYZE",
+    ],
+    # 3: отметка об отправленном напоминании
+    [
+        "ALTER TABLE schedule_events ADD COLUMN reminder_sent_at DATETIME",
+        "CREATE INDEX IF NOT EXISTS ix_schedule_events_pending_reminder "
+        "ON schedule_events (event_date) WHERE reminder_sent_at IS NULL",
+    ],
+    # 4: кэш file_id мотивационных файлов
+    [
+        """CREATE TABLE IF NOT EXISTS media_files (
+            path VARCHAR(300) NOT NULL,
+            file_id VARCHAR(200) NOT NULL,
+            updated_at DATETIME,
+            PRIMARY KEY (path)
+        )""",
+    ],
+    # 5: хранилище мотивации без дубликатов
+    [
+        """CREATE TABLE IF NOT EXISTS stored_media (
+            sha256 VARCHAR(64) NOT NULL,
+            path VARCHAR(300) NOT NULL,
+            size INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (sha256)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_stored_media_user_id ON stored_media (user_id)",
+        """CREATE TABLE IF NOT EXISTS media_aliases (
+            file_unique_id VARCHAR(100) NOT NULL,
+            sha256 VARCHAR(64) NOT NULL,
+            PRIMARY KEY (file_unique_id)
+        )""",
+    ],
+    # 6: состояния диалогов (FSM)
+    [
+        """CREATE TABLE IF NOT EXISTS fsm_states (
+            key VARCHAR(200) NOT NULL,
+            state VARCHAR(100),
+            data TEXT NOT NULL,
+            updated_at DATETIME NOT NULL,
+            PRIMARY KEY (key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_fsm_states_updated_at ON fsm_states (updated_at)",
+    ],
+    # 7: архив выполненных заданий и прошедших событий
+    [
+        """CREATE TABLE IF NOT EXISTS homeworks_archive (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            subject VARCHAR(100) NOT NULL,
+            task VARCHAR(500) NOT NULL,
+            deadline DATETIME,
+            is_done BOOLEAN,
+            created_at DATETIME,
+            archived_at DATETIME NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_homeworks_archive_user_deadline ON homeworks_archive (user_id, deadline)",
+        """CREATE TABLE IF NOT EXISTS schedule_events_archive (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            subject VARCHAR(100) NOT NULL,
+            event_type VARCHAR(50) NOT NULL,
+            event_date DATETIME NOT NULL,
+            description VARCHAR(300),
+            created_at DATETIME,
+            reminder_sent_at DATETIME,
+            archived_at DATETIME NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_schedule_events_archive_user_date "
+        "ON schedule_events_archive (user_id, event_date)",
+        # Режим auto_vacuum для архива включается после миграций (см. _enable_incremental_vacuum)
+    ],
+    # 8: настройки пользователя (ежедневная сводка)
+    [
+        """CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER NOT NULL,
+            digest_time VARCHAR(5),
+            digest_sent_at DATETIME,
+            PRIMARY KEY (user_id)
+        )""",
+    ],
+    # 9: отметка об обработке картинок мотивации
+    [
+        "ALTER TABLE stored_media ADD COLUMN normalized_at DATETIME",
+    ],
+    # 10: версия состояния диалога для записи из нескольких процессов
+    [
+        "ALTER TABLE fsm_states ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+    ],
+    # 11: версии списков пользователей для кэша списков в нескольких процессах
+    [
+        """CREATE TABLE IF NOT EXISTS listing_versions (
+            user_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (user_id)
+        )""",
+    ],
+]
+
+def run_migrations(engine):
+    """Применяет к БД все миграции, которые еще не были применены.
+
+    Каждая миграция выполняется в своей транзакции вместе с увеличением user_version:
+    упавшая на середине миграция откатывается целиком и при следующем запуске повторяется.
+    """
+    # pysqlite не открывает транзакцию перед DDL даже внутри engine.begin(), поэтому
+    # в режиме AUTOCOMMIT драйвер в транзакции не вмешивается, а BEGIN/COMMIT отдаются явно
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+            logging.info(f"Применяю миграцию БД №{number}")
+            conn.exec_driver_sql("BEGIN")
+            try:
+                for statement in statements:
+                    conn.exec_driver_sql(statement)
+                conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+                conn.exec_driver_sql("COMMIT")
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+        _enable_incremental_vacuum(conn)
+
+def _enable_incremental_vacuum(conn):
+    """Включает auto_vacuum = INCREMENTAL, если он еще не включен.
+
+    Освобожденные архивированием страницы возвращаются системе через PRAGMA incremental_vacuum.
+    Включить режим у существующей БД можно только полным VACUUM, а он не выполняется
+    внутри транзакции - поэтому это отдельный шаг, который повторяется, пока не удастся.
+    """
+    if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:  # 2 - INCREMENTAL
+        logging.info("Включаю auto_vacuum = INCREMENTAL")
+        conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+# ===== Подключение к SQLite =====
+DB_URL = os.getenv("DB_URL", "sqlite:///./school_bot.db")
+DB_WORKERS = 4  # Потоков для запросов к БД (см. run_db)
+DB_BUSY_TIMEOUT = 5  # Сколько секунд ждать, пока другой поток освободит блокировку записи
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Чтение не блокирует запись и наоборот
+    # В режиме WAL с NORMAL fsync делается только при контрольной точке: падение бота транзакции
+    # не теряет, а при отключении питания могут пропасть лишь последние из них
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # Кэш страниц в КиБ (отрицательное значение) на каждое соединение
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": DB_BUSY_TIMEOUT * 1000,
+}
+
+def is_memory_db(url):
+    """БД в памяти (sqlite:// или sqlite:///:memory:), например в тестах"""
+    return make_url(url).database in (None, "", ":memory:")
+
+def create_db_engine(url):
+    """Движок с пулом соединений, каждое из которых настраивается SQLITE_PRAGMAS"""
+    if is_memory_db(url):
+        # У каждого соединения была бы своя пустая БД, поэтому все потоки делят одно
+        pool_args = {"poolclass": StaticPool}
+    else:
+        pool_args = {
+            "pool_size": DB_WORKERS + 1,  # Потоки run_db и поток групповой записи
+            "max_overflow": DB_WORKERS,
+        }
+    db_engine = create_engine(
+        url,
+        connect_args={"timeout": DB_BUSY_TIMEOUT, "check_same_thread": False},
+        **pool_args,
+    )
+
+    @listens_for(db_engine, "connect")
+    def _configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return db_engine
+
+engine = None  # Создается в create_app()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False)
+
+# ===== Метрики =====
+# Время обработчиков, запросов к БД и вызовов Bot API собирается в памяти процесса
+# и отдается в формате Prometheus по /metrics, а администраторам - командой /perf
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы в секундах
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# Метрики отдаются отдельным сервером, не на публичном адресе webhook: по умолчанию только локально
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 - сервер метрик выключен
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Если задан, /metrics требует заголовок Authorization: Bearer <токен>
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+def _format_labels(label_name, label):
+    if label_name is None:
+        return ""
+    value = str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{label_name}="{value}"'
+
+class Counter:
+    """Счетчик с одной меткой (или без меток, если label_name=None).
+
+    Если задан collect(), значения не накапливаются, а читаются из него при каждом
+    обращении - так отдаются счетчики, которые уже ведут другие части бота.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_name=None, collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.collect = collect
+        self.values = {}
+        self._lock = threading.Lock()  # Счетчики обновляются и из потоков БД
+
+    def inc(self, label=None, amount=1):
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def samples(self):
+        if self.collect:
+            self.values = self.collect() if self.label_name else {None: self.collect()}
+        for label, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = _format_labels(self.label_name, label)
+            yield f"{self.name}{{{labels}}}" if labels else self.name, value
+
+class Gauge(Counter):
+    """Текущее значение, которое может как расти, так и уменьшаться"""
+    kind = "gauge"
+
+    def set(self, value, label=None):
+        self.values[label] = value
+
+class Histogram:
+    """Распределение значений (по умолчанию длительностей) по корзинам с одной меткой или без меток"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_name, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = buckets
+        self.series = {}  # метка -> [счетчики по корзинам..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def summary(self, label):
+        """Количество, среднее и оценка p95 (верхняя граница корзины) в секундах"""
+        series = self.series[label]
+        count = series[-1]
+        rank, seen = count * 0.95, 0
+        p95 = float("inf")
+        for bound, bucket_count in zip(self.buckets, series):
+            seen += bucket_count
+            if seen >= rank:
+                p95 = bound
+                break
+        return count, series[-2] / count, p95
+
+    def samples(self):
+        for label, series in sorted(self.series.items()):
+            labels = _format_labels(self.label_name, label)
+            prefix = f"{labels}," if labels else ""
+            total = 0
+            for bound, bucket_count in zip(self.buckets, series):
+                total += bucket_count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}}', total
+            yield f'{self.name}_bucket{{{prefix}le="+Inf"}}', series[-1]
+            yield f"{self.name}_sum{{{labels}}}" if labels else f"{self.name}_sum", series[-2]
+            yield f"{self.name}_count{{{labels}}}" if labels else f"{self.name}_count", series[-1]
+
+METRICS = []
+
+def metric(instance):
+    METRICS.append(instance)
+    return instance
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for instance in METRICS:
+        lines.append(f"# HELP {instance.name} {instance.help_text}")
+        lines.append(f"# TYPE {instance.name} {instance.kind}")
+        lines.extend(f"{name} {value}" for name, value in instance.samples())
+    return "\n".join(lines) + "\n"
+
+handler_seconds = metric(Histogram("bot_handler_seconds", "Время работы обработчиков обновлений", "handler"))
+handler_errors = metric(Counter("bot_handler_errors_total", "Исключения, вышедшие из обработчиков", "handler"))
+logged_errors = metric(Counter("bot_logged_errors_total", "Ошибки, записанные в лог", "logger"))
+db_call_seconds = metric(Histogram("bot_db_call_seconds", "Время вызова run_db вместе с ожиданием потока", "function"))
+db_query_seconds = metric(Histogram("bot_db_query_seconds", "Время выполнения SQL-запросов", "statement"))
+db_commit_seconds = metric(Histogram("bot_db_commit_seconds", "Время фиксации транзакций", "function"))
+api_seconds = metric(Histogram("bot_api_seconds", "Время вызовов Bot API без ожидания в очереди", "method"))
+api_errors = metric(Counter("bot_api_errors_total", "Неудачные вызовы Bot API", "method"))
+reminder_lag = metric(Gauge("bot_reminder_lag_seconds", "Опоздание последнего отправленного напоминания"))
+reminder_loop_lag = metric(Gauge("bot_reminder_loop_lag_seconds", "Насколько позже срока проснулся цикл напоминаний"))
+
+class ErrorLogCounter(logging.Handler):
+    """Считает записи уровня ERROR и выше: большинство обработчиков ловят исключения сами и пишут в лог"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        logged_errors.inc(record.name)
+
+error_log_counter = ErrorLogCounter()  # Подключается к корневому логгеру в create_app()
+
+def handler_name(data):
+    """Имя сработавшего обработчика; кнопки меню вызываются через общий обработчик роутера (см. MenuRouter)"""
+    callback = data.get("menu_callback") or data["handler"].callback
+    return callback.__name__
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware диспетчера: меряет только сработавший обработчик"""
+
+    async def __call__(self, handler, event, data):
+        name = handler_name(data)
+        started = perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, perf_counter() - started)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота; подключается после очереди исходящих, поэтому меряет сам запрос"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            api_errors.inc(name)
+            raise
+        finally:
+            api_seconds.observe(name, perf_counter() - started)
+
+# Время начала хранится в контексте выполнения запроса: after_cursor_execute не вызывается,
+# если запрос упал, и в соединении от таких запросов копились бы записи
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = perf_counter()
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "query_started", None)
+    if started is not None:
+        db_query_seconds.observe(statement.split(None, 1)[0].upper(), perf_counter() - started)
+
+def instrument_engine(db_engine):
+    """Подключает к движку замер времени SQL-запросов"""
+    listen(db_engine, "before_cursor_execute", _query_started)
+    listen(db_engine, "after_cursor_execute", _query_finished)
+
+# ===== Асинхронный доступ к БД =====
+# Синхронные запросы SQLAlchemy выполняются в отдельном пуле потоков,
+# чтобы не блокировать цикл событий aiogram
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+def _run_in_session(sessions, func, args):
+    db = sessions()
+    try:
+        result = func(db, *args)
+        started = perf_counter()
+        db.commit()
+        db_commit_seconds.observe(func.__name__, perf_counter() - started)
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+async def _call_db(sessions, func, args):
+    loop = asyncio.get_running_loop()
+    started = perf_counter()
+    try:
+        return await loop.run_in_executor(db_executor, _run_in_session, sessions, func, args)
+    finally:
+        db_call_seconds.observe(func.__name__, perf_counter() - started)
+
+async def run_db(func, *args):
+    """Выполняет func(db, *args) в потоке основной БД и возвращает результат"""
+    return await _call_db(SessionLocal, func, args)
 
-engine = create_engine("sqlite:///./school_bot.db")
-Base.metadata.create_all(bind=engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# ===== Групповая фиксация записей =====
+DB_GROUP_COMMIT_WINDOW = 0.003  # Сколько секунд собирать записи в одну транзакцию
+DB_GROUP_COMMIT_MAX = 128  # Больше записей в одну транзакцию не кладем
+
+db_group_commit_size = metric(Histogram("bot_db_group_commit_size", "Записей в одной групповой транзакции",
+                                        None, buckets=(1, 2, 4, 8, 16, 32, 64, 128)))
+
+def _run_batch(sessions, batch):
+    """Выполняет пачку записей в одной транзакции и возвращает [(результат, исключение), ...]"""
+    db = sessions()
+    try:
+        outcomes = []
+        for fn, args, _ in batch:
+            try:
+                outcomes.append((fn(db, *args), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        if not any(error for _, error in outcomes):
+            started = perf_counter()
+            db.commit()
+            db_commit_seconds.observe("group_commit", perf_counter() - started)
+            return outcomes
+        db.rollback()
+    except Exception:
+        # Не удалась сама фиксация - ниже каждая запись повторится отдельно
+        db.rollback()
+    finally:
+        db.close()
+
+    # Ошибка одной записи не должна отменять чужие: выполняем пачку по одной, каждую в своей транзакции
+    outcomes = []
+    for fn, args, _ in batch:
+        try:
+            outcomes.append((_run_in_session(sessions, fn, args), None))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+class GroupCommitWriter:
+    """Групповая фиксация коротких записей.
+
+    Записи, пришедшие от разных пользователей в течение DB_GROUP_COMMIT_WINDOW
+    (и пока выполняется предыдущая пачка), выполняются одна за другой в одной
+    транзакции с одним fsync. Пишет один поток, поэтому записи не борются за
+    блокировку SQLite между собой. У каждого файла БД свой писатель.
+    """
+
+    def __init__(self, sessions, window=DB_GROUP_COMMIT_WINDOW, max_batch=DB_GROUP_COMMIT_MAX):
+        self.sessions = sessions
+        self.window = window
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._loop = None
+        self._queue = None
+        self._task = None
+
+    async def submit(self, func, args):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Очередь и задача привязаны к циклу событий, а он может смениться (например, между тестами)
+            self._loop, self._queue, self._task = loop, asyncio.Queue(), None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((func, args, future))
+        return await future
+
+    async def _collect(self, batch):
+        """Дополняет пустой batch записями из очереди"""
+        batch.append(await self._queue.get())
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            if self._queue.empty():
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                await self._collect(batch)
+                db_group_commit_size.observe(None, len(batch))
+                try:
+                    outcomes = await loop.run_in_executor(self._executor, _run_batch, self.sessions, batch)
+                except Exception as e:
+                    outcomes = [(None, e)] * len(batch)
+                for (_, _, future), (result, error) in zip(batch, outcomes):
+                    if future.done():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+                batch = []
+        except Exception as e:
+            logging.error(f"Ошибка групповой записи: {e}")
+        finally:
+            # Задача остановилась (ошибка или отмена): ожидающие записи не должны висеть вечно.
+            # Следующий submit запустит ее заново
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Групповая запись остановлена, результат записи неизвестен"))
+
+db_writer = GroupCommitWriter(SessionLocal)
+
+async def _write_through(writer, func, args):
+    started = perf_counter()
+    try:
+        return await writer.submit(func, args)
+    finally:
+        db_call_seconds.observe(func.__name__, perf_counter() - started)
+
+async def write_db(func, *args):
+    """Как run_db, но для коротких записей: func(db, *args) фиксируется вместе с соседними записями"""
+    return await _write_through(db_writer, func, args)
+
+# ===== Шарды заданий и событий =====
+# Задания и события (вместе с архивом) лежат в DB_SHARDS файлах SQLite, пользователь
+# попадает в шард по хэшу user_id. У каждого шарда своя блокировка записи и свой поток
+# групповой фиксации, поэтому записи разных пользователей не ждут друг друга.
+# Остальные таблицы (мотивация, FSM, настройки) остаются в основной БД. При одном шарде
+# он и есть основная БД. Поменять число шардов у существующей БД: python reshard.py --shards N
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+SHARDED_MODELS = (Homework, ScheduleEvent, HomeworkArchive, ScheduleEventArchive)
+
+def shard_urls(db_url, count):
+    """URL файлов шардов: school_bot.db -> school_bot.shard-0-of-4.db, ...; один шард - сама основная БД"""
+    if count == 1:
+        return [db_url]
+    if is_memory_db(db_url):
+        return [db_url] * count  # Каждый движок получает свою БД в памяти
+    base, extension = os.path.splitext(db_url)
+    return [f"{base}.shard-{index}-of-{count}{extension or '.db'}" for index in range(count)]
+
+def shard_index(user_id, count):
+    # crc32, а не hash(): номер шарда не должен зависеть от процесса и версии Python
+    return zlib.crc32(str(user_id).encode()) % count
+
+class DBShard:
+    """Файл БД с заданиями и событиями части пользователей"""
+
+    def __init__(self, index, db_engine, sessions, writer):
+        self.index = index
+        self.engine = db_engine
+        self.sessions = sessions
+        self.writer = writer
+
+    async def run(self, func, *args):
+        return await _call_db(self.sessions, func, args)
+
+    async def write(self, func, *args):
+        return await _write_through(self.writer, func, args)
+
+shards = []  # Подключаются в create_app()
+
+def connect_shard(index, url):
+    """Подключается к файлу шарда, применяя к нему миграции"""
+    shard_engine = create_db_engine(url)
+    instrument_engine(shard_engine)
+    # Схема у шардов общая с основной БД: лишние пустые таблицы проще, чем второй список миграций
+    run_migrations(shard_engine)
+    sessions = sessionmaker(bind=shard_engine, autocommit=False, autoflush=False, expire_on_commit=False)
+    return DBShard(index, shard_engine, sessions, GroupCommitWriter(sessions))
+
+def open_shards(db_url, count):
+    if count == 1:
+        return [DBShard(0, engine, SessionLocal, db_writer)]
+    return [connect_shard(index, url) for index, url in enumerate(shard_urls(db_url, count))]
+
+def user_shard(user_id):
+    return shards[shard_index(user_id, len(shards))]
+
+async def run_user_db(func, user_id, *args):
+    """Как run_db, но func(db, user_id, *args) выполняется в шарде пользователя"""
+    return await user_shard(user_id).run(func, user_id, *args)
+
+async def write_user_db(func, user_id, *args):
+    """Как write_db, но в шарде пользователя"""
+    return await user_shard(user_id).write(func, user_id, *args)
+
+async def run_all_shards(func, *args):
+    """Выполняет func(db, *args) во всех шардах параллельно и возвращает список результатов"""
+    return await asyncio.gather(*(shard.run(func, *args) for shard in shards))
+
+def _count_sharded_rows(db: Session):
+    return sum(db.query(func.count(model.id)).scalar() for model in SHARDED_MODELS)
+
+def find_stale_shards(db_url, count):
+    """Файлы шардов с другим числом шардов: их данные при текущем DB_SHARDS не видны"""
+    if is_memory_db(db_url):
+        return []
+    database = make_url(db_url).database
+    base, extension = os.path.splitext(database)
+    current = {make_url(url).database for url in shard_urls(db_url, count)}
+    return sorted(path for path in glob.glob(f"{glob.escape(base)}.shard-*-of-*{extension or '.db'}")
+                  if path not in current)
+
+def check_shard_layout(db_url, count):
+    """Не дает запустить бота, если задания и события лежат не в тех файлах, что задает DB_SHARDS"""
+    stale = find_stale_shards(db_url, count)
+    if count > 1 and _run_in_session(SessionLocal, _count_sharded_rows, ()):
+        stale.insert(0, make_url(db_url).database)
+    if stale:
+        raise RuntimeError(f"Задания и события лежат в {', '.join(stale)}, а не в {count} шардах: "
+                           f"перенеси их командой python reshard.py --shards {count}")
+
+def _add_homework(db: Session, user_id, subject, task, deadline):
+    homework = Homework(user_id=user_id, subject=subject, task=task, deadline=deadline)
+    db.add(homework)
+    return homework
+
+def _add_event(db: Session, user_id, subject, event_type, event_date, description):
+    event = ScheduleEvent(
+        user_id=user_id,
+        subject=subject,
+        event_type=event_type,
+        event_date=event_date,
+        description=description
+    )
+    db.add(event)
+    return event
+
+def _mark_homeworks_done(db: Session, user_id, homework_ids):
+    """Отмечает задания выполненными одним UPDATE. Чужие и уже выполненные задания не меняются"""
+    return db.query(Homework) \
+        .filter(Homework.user_id == user_id) \
+        .filter(Homework.id.in_(homework_ids)) \
+        .filter(Homework.is_done == False) \
+        .update({Homework.is_done: True}, synchronize_session=False)
+
+LISTING_PAGE_SIZE = 5  # Сколько записей показывать на одной странице списка
+
+def _query_homework_page(db: Session, model, user_id, direction, cursor, *criteria):
+    """Запрос страницы по ключу (deadline, id) к таблице заданий model, LIMIT на одну запись больше страницы"""
+    query = db.query(model.id, model.subject, model.task, model.deadline) \
+        .filter(model.user_id == user_id, *criteria)
+    no_deadline = model.deadline.is_(None)
+    if direction == "next":
+        deadline, last_id = cursor
+        if deadline is None:
+            query = query.filter(or_(and_(no_deadline, model.id > last_id), ~no_deadline))
+        else:
+            query = query.filter(tuple_(model.deadline, model.id) > tuple_(deadline, last_id))
+    elif direction == "prev":
+        deadline, first_id = cursor
+        if deadline is None:
+            query = query.filter(no_deadline, model.id < first_id)
+        else:
+            query = query.filter(or_(no_deadline, tuple_(model.deadline, model.id) < tuple_(deadline, first_id)))
+
+    if direction == "prev":
+        return query.order_by(model.deadline.desc(), model.id.desc()).limit(LISTING_PAGE_SIZE + 1)
+    return query.order_by(model.deadline.asc(), model.id.asc()).limit(LISTING_PAGE_SIZE + 1)
+
+def _homework_sort_key(hw):
+    # Так же, как ORDER BY deadline, id в SQLite: задания без срока (NULL) идут первыми
+    return hw.deadline is not None, hw.deadline or datetime.min, hw.id
+
+def _get_homework_page(db: Session, user_id, is_done, direction=None, cursor=None):
+    """Страница заданий, упорядоченных по (deadline, id); задания без срока идут первыми.
+
+    direction="next" возвращает записи после cursor, "prev" - перед ним.
+    Завершенные задания собираются из homeworks и из архива.
+    Возвращает (записи, есть ли еще записи в этом направлении).
+    """
+    rows = _query_homework_page(db, Homework, user_id, direction, cursor, Homework.is_done == is_done).all()
+    if is_done:
+        # Обе выборки уже упорядочены и ограничены, поэтому для страницы достаточно их слияния
+        rows += _query_homework_page(db, HomeworkArchive, user_id, direction, cursor).all()
+        rows = sorted(rows, key=_homework_sort_key, reverse=direction == "prev")[:LISTING_PAGE_SIZE + 1]
+
+    if direction == "prev":
+        return rows[:LISTING_PAGE_SIZE][::-1], len(rows) > LISTING_PAGE_SIZE
+    return rows[:LISTING_PAGE_SIZE], len(rows) > LISTING_PAGE_SIZE
+
+def _get_event_page(db: Session, user_id, since, direction=None, cursor=None):
+    """Страница событий начиная с since, упорядоченных по (event_date, id)"""
+    query = db.query(ScheduleEvent.id, ScheduleEvent.subject, ScheduleEvent.event_type,
+                     ScheduleEvent.event_date, ScheduleEvent.description) \
+        .filter(ScheduleEvent.user_id == user_id) \
+        .filter(ScheduleEvent.event_date >= since)
+    key = tuple_(ScheduleEvent.event_date, ScheduleEvent.id)
+    if direction == "prev":
+        rows = query.filter(key < tuple_(*cursor)) \
+            .order_by(ScheduleEvent.event_date.desc(), ScheduleEvent.id.desc()) \
+            .limit(LISTING_PAGE_SIZE + 1).all()
+        return rows[:LISTING_PAGE_SIZE][::-1], len(rows) > LISTING_PAGE_SIZE
+    if direction == "next":
+        query = query.filter(key > tuple_(*cursor))
+    rows = query.order_by(ScheduleEvent.event_date.asc(), ScheduleEvent.id.asc()) \
+        .limit(LISTING_PAGE_SIZE + 1).all()
+    return rows[:LISTING_PAGE_SIZE], len(rows) > LISTING_PAGE_SIZE
+
+def _get_db_stats(db: Session, user_id):
+    hw_count = db.query(func.count(Homework.id)).filter(Homework.user_id == user_id).scalar()
+    events_count = db.query(func.count(ScheduleEvent.id)).filter(ScheduleEvent.user_id == user_id).scalar()
+    last_hw = db.query(Homework).filter(Homework.user_id == user_id) \
+        .order_by(Homework.created_at.desc()).limit(3).all()
+    last_events = db.query(ScheduleEvent).filter(ScheduleEvent.user_id == user_id) \
+        .order_by(ScheduleEvent.created_at.desc()).limit(3).all()
+    return hw_count, events_count, last_hw, last_events
+
+def _get_pending_reminders(db: Session, start, end):
+    return db.query(ScheduleEvent) \
+        .filter(ScheduleEvent.reminder_sent_at.is_(None)) \
+        .filter(ScheduleEvent.event_date > start) \
+        .filter(ScheduleEvent.event_date <= end) \
+        .all()
+
+def _get_media_file_ids(db: Session):
+    return {media.path: media.file_id for media in db.query(MediaFile).all()}
+
+def _save_media_file_id(db: Session, path, file_id):
+    db.merge(MediaFile(path=path, file_id=file_id))
+
+def _delete_media_file_id(db: Session, path):
+    db.query(MediaFile).filter(MediaFile.path == path).delete(synchronize_session=False)
+
+def _find_media_by_unique_id(db: Session, file_unique_id):
+    return db.query(StoredMedia) \
+        .join(MediaAlias, MediaAlias.sha256 == StoredMedia.sha256) \
+        .filter(MediaAlias.file_unique_id == file_unique_id) \
+        .first()
+
+def _check_media_quota(db: Session, user_id, size):
+    """Возвращает "user" или "total", если новый файл не помещается в квоту"""
+    user_files = db.query(func.count(StoredMedia.sha256)).filter(StoredMedia.user_id == user_id).scalar()
+    if user_files >= MOTIVATION_USER_QUOTA:
+        return "user"
+    total_size = db.query(func.coalesce(func.sum(StoredMedia.size), 0)).scalar()
+    if total_size + size > MOTIVATION_TOTAL_QUOTA:
+        return "total"
+    return None
+
+def _register_media(db: Session, sha256, path, size, user_id, file_unique_id):
+    """Сохраняет файл в хранилище. Возвращает (путь к файлу, был ли он новым)"""
+    # Один и тот же файл могут загружать одновременно, поэтому вставки не падают на уже существующих строках
+    db.execute(sqlite_insert(MediaAlias).values(file_unique_id=file_unique_id, sha256=sha256)
+               .on_conflict_do_update(index_elements=[MediaAlias.file_unique_id], set_={"sha256": sha256}))
+    inserted = db.execute(sqlite_insert(StoredMedia)
+                          .values(sha256=sha256, path=path, size=size, user_id=user_id)
+                          .on_conflict_do_nothing(index_elements=[StoredMedia.sha256]))
+    if inserted.rowcount:
+        return path, True
+    return db.get(StoredMedia, sha256).path, False
+
+def _get_marked_days(db: Session, user_id, year, month):
+    """Дни месяца, на которые у пользователя есть события или сроки заданий"""
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    events = db.query(func.strftime('%d', ScheduleEvent.event_date)) \
+        .filter(ScheduleEvent.user_id == user_id) \
+        .filter(ScheduleEvent.event_date >= start) \
+        .filter(ScheduleEvent.event_date < end)
+    archived_events = db.query(func.strftime('%d', ScheduleEventArchive.event_date)) \
+        .filter(ScheduleEventArchive.user_id == user_id) \
+        .filter(ScheduleEventArchive.event_date >= start) \
+        .filter(ScheduleEventArchive.event_date < end)
+    deadlines = db.query(func.strftime('%d', Homework.deadline)) \
+        .filter(Homework.user_id == user_id) \
+        .filter(Homework.is_done == False) \
+        .filter(Homework.deadline >= start) \
+        .filter(Homework.deadline < end)
+    return frozenset(int(day) for (day,) in events.union(archived_events, deadlines).all())
+
+def _load_fsm_state(db: Session, key, not_before, known_version=None):
+    """(состояние, данные, версия) из БД или None, если там все еще known_version. Нет записи - версия 0"""
+    record = db.get(FSMRecord, key)
+    version = record.version if record else 0
+    if version == known_version:
+        return None
+    if record is None or record.updated_at < not_before:
+        return None, "{}", version
+    return record.state, record.data, version
+
+def _save_fsm_states(db: Session, records):
+    """Записывает состояния, только если с момента чтения их версия в БД не изменилась.
+
+    Возвращает {ключ: новая версия}. Ключей, которые успел записать другой процесс, в нем нет.
+    """
+    saved = {}
+    for key, state, data, updated_at, version in records:
+        if version:
+            # Сброшенный диалог тоже остается записью с новой версией, иначе после удаления
+            # и повторного создания версия повторилась бы. Ее удалит _delete_expired_fsm_states
+            matched = db.query(FSMRecord) \
+                .filter(FSMRecord.key == key, FSMRecord.version == version) \
+                .update({FSMRecord.state: state, FSMRecord.data: data, FSMRecord.updated_at: updated_at,
+                         FSMRecord.version: FSMRecord.version + 1}, synchronize_session=False)
+            if matched:
+                saved[key] = version + 1
+        elif state is None and data == "{}":
+            if db.get(FSMRecord, key) is None:
+                saved[key] = 0
+        else:
+            inserted = db.execute(sqlite_insert(FSMRecord)
+                                  .values(key=key, state=state, data=data, updated_at=updated_at, version=1)
+                                  .on_conflict_do_nothing(index_elements=[FSMRecord.key]))
+            if inserted.rowcount:
+                saved[key] = 1
+    return saved
+
+def _delete_expired_fsm_states(db: Session, not_before):
+    return db.query(FSMRecord).filter(FSMRecord.updated_at < not_before).delete(synchronize_session=False)
+
+def _insert_rows(db: Session, model, rows):
+    """Вставляет пачку строк одним executemany"""
+    db.execute(insert(model), rows)
+    return len(rows)
+
+def _iter_user_events(db: Session, user_id, batch_size=500):
+    """Все события пользователя: сначала архивные, затем из schedule_events"""
+    for model in (ScheduleEventArchive, ScheduleEvent):
+        yield from db.query(model) \
+            .filter(model.user_id == user_id) \
+            .order_by(model.event_date, model.id) \
+            .yield_per(batch_size)
+
+def _iter_user_homeworks(db: Session, user_id, batch_size=500):
+    """Все задания пользователя: сначала архивные, затем из homeworks"""
+    for model in (HomeworkArchive, Homework):
+        yield from db.query(model) \
+            .filter(model.user_id == user_id) \
+            .order_by(model.deadline, model.id) \
+            .yield_per(batch_size)
+
+def _claim_reminder(db: Session, user_id, event_id):
+    """Помечает напоминание отправленным. Возвращает время отметки или None, если это уже кто-то сделал"""
+    claimed_at = datetime.now()
+    updated = db.query(ScheduleEvent) \
+        .filter(ScheduleEvent.id == event_id) \
+        .filter(ScheduleEvent.user_id == user_id) \
+        .filter(ScheduleEvent.reminder_sent_at.is_(None)) \
+        .update({ScheduleEvent.reminder_sent_at: claimed_at}, synchronize_session=False)
+    return claimed_at if updated == 1 else None
+
+def _release_reminder(db: Session, user_id, event_id, claimed_at):
+    """Снимает отметку, поставленную _claim_reminder, если ее никто не поменял. Возвращает, удалось ли"""
+    updated = db.query(ScheduleEvent) \
+        .filter(ScheduleEvent.id == event_id) \
+        .filter(ScheduleEvent.user_id == user_id) \
+        .filter(ScheduleEvent.reminder_sent_at == claimed_at) \
+        .update({ScheduleEvent.reminder_sent_at: None}, synchronize_session=False)
+    return updated == 1
+
+def _bump_listing_version(db: Session, user_id):
+    db.execute(sqlite_insert(ListingVersion).values(user_id=user_id, version=1)
+               .on_conflict_do_update(index_elements=[ListingVersion.user_id],
+                                      set_={"version": ListingVersion.version + 1}))
+
+@lru_cache(maxsize=None)
+def _with_listing_version(func):
+    """Запрос списка func, который сначала читает версию списков пользователя.
+
+    Возвращает (версия, изменилась ли она, результат func) - если версия в БД все еще
+    known_version, func не выполняется. Версия читается до данных, поэтому результат
+    никогда не бывает старше своей версии.
+    """
+    def query(db: Session, user_id, known_version, *args):
+        version = db.query(ListingVersion.version).filter(ListingVersion.user_id == user_id).scalar() or 0
+        if version == known_version:
+            return version, False, None
+        return version, True, func(db, user_id, *args)
+    query.__name__ = func.__name__  # Время запросов к БД учитывается по имени исходного запроса
+    return query
+
+# ===== Кэш списков пользователя =====
+LISTING_CACHE_USERS = 10000  # Для скольких пользователей держать списки в памяти
+LISTING_CACHE_TTL = 300  # Сколько секунд список считается актуальным
+
+class ListingCache:
+    """Кэш результатов запросов списков по пользователям (LRU + время жизни).
+
+    get() выполняет запрос func(db, user_id, *args) в шарде пользователя. Все обработчики,
+    меняющие данные пользователя, должны вызывать invalidate(user_id) - он увеличивает
+    версию списков пользователя в БД. Данные могут менять и другие процессы бота, поэтому
+    результат из кэша отдается, только если версия в БД не изменилась. Ее проверка идет
+    тем же обращением к БД и стоит одного запроса по первичному ключу вместо запроса списка.
+    """
+
+    def __init__(self, max_users=LISTING_CACHE_USERS, ttl=LISTING_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()  # user_id -> [версия, {(func, args): (истекает, результат)}]
+
+    async def get(self, user_id, func, *args):
+        key = (func, args)
+        cached = known_version = None
+        user = self._users.get(user_id)
+        if user is not None:
+            self._users.move_to_end(user_id)
+            cached = user[1].get(key)
+            if cached and cached[0] > monotonic():
+                known_version = user[0]
+
+        version, changed, result = await run_user_db(_with_listing_version(func), user_id, known_version, *args)
+        if not changed:
+            return cached[1]
+        user = self._users.get(user_id)
+        if user is None or user[0] < version:
+            user = self._users[user_id] = [version, {}]
+        # Если версия в кэше новее, данные поменялись, пока шел запрос, и результат уже устарел
+        if user[0] == version:
+            user[1][key] = (monotonic() + self.ttl, result)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return result
+
+    async def invalidate(self, user_id):
+        self._users.pop(user_id, None)
+        await write_user_db(_bump_listing_version, user_id)
+
+listing_cache = ListingCache()
+
+# ===== Хранилище состояний диалогов (FSM) =====
+FSM_FLUSH_INTERVAL = 1  # Как часто (в секундах) измененные состояния записываются в БД
+FSM_CACHE_TTL = 60  # Через сколько секунд без обращений состояние убирается из кэша
+FSM_STATE_TTL = timedelta(days=1)  # Через сколько брошенный диалог сбрасывается
+FSM_CLEANUP_EVERY = 600  # Раз во сколько сбросов кэша удалять из БД просроченные состояния
+
+def _fsm_encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Не могу сохранить в FSM значение типа {type(value).__name__}")
+
+def _fsm_decode(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с кэшем в памяти и отложенной записью.
+
+    Изменения копятся в памяти и раз в FSM_FLUSH_INTERVAL секунд записываются в БД
+    одной транзакцией. Состояния, которые не менялись дольше FSM_STATE_TTL, считаются
+    брошенными и удаляются.
+
+    С одной БД могут работать несколько процессов бота, поэтому у каждой записи есть
+    версия. Чтение сверяет версию из кэша с БД (данные перечитываются, только если
+    она изменилась), а запись проходит, только если версия в БД та же, что была
+    при чтении. Если другой процесс успел записать состояние раньше, локальное
+    изменение отбрасывается и следующее чтение возьмет его версию.
+    """
+
+    def __init__(self, flush_interval=FSM_FLUSH_INTERVAL, cache_ttl=FSM_CACHE_TTL, state_ttl=FSM_STATE_TTL):
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.state_ttl = state_ttl
+        self._cache = {}  # ключ -> [состояние, данные, время обращения, время изменения, версия в БД]
+        self._dirty = set()
+        self._in_flight = set()  # Ключи, которые сейчас записываются в БД
+        self._flush_task = None
+
+    @staticmethod
+    def _make_key(key: StorageKey):
+        return ":".join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                                key.business_connection_id, key.destiny))
+
+    def _pending(self, k):
+        # Пока изменение не зафиксировано в БД, в ней лежит старое состояние и перечитывать его нельзя
+        return k in self._dirty or k in self._in_flight
+
+    async def _entry(self, key: StorageKey):
+        k = self._make_key(key)
+        entry = self._cache.get(k)
+        if entry is not None and self._pending(k):
+            return k, entry
+        # Состояние мог изменить другой процесс бота, поэтому версия из кэша сверяется с БД
+        record = await run_db(_load_fsm_state, k, datetime.now() - self.state_ttl, entry[4] if entry else None)
+        if self._pending(k):
+            return k, self._cache[k]  # Состояние изменили, пока шло чтение
+        if record is not None:
+            state, data, version = record
+            entry = [state, json.loads(data, object_hook=_fsm_decode), None, None, version]
+        entry[2] = monotonic()
+        self._cache[k] = entry
+        return k, entry
+
+    def _touch(self, k, entry):
+        entry[2] = monotonic()
+        entry[3] = datetime.now()
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(k, entry)
+
+    async def get_state(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data):
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._touch(k, entry)
+
+    async def get_data(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return dict(entry[1])
+
+    async def flush(self):
+        """Записывает накопленные изменения в БД"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        self._in_flight |= dirty
+        records = []
+        for k in dirty:
+            state, data, _, updated_at, version = self._cache[k]
+            records.append((k, state, json.dumps(data, default=_fsm_encode, ensure_ascii=False), updated_at, version))
+        try:
+            saved = await run_db(_save_fsm_states, records)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        else:
+            for k in dirty:
+                if k in saved:
+                    self._cache[k][4] = saved[k]
+                else:
+                    # Другой процесс записал состояние раньше: его версия новее, а локальное изменение отбрасывается
+                    logging.warning(f"Состояние FSM {k} изменено другим процессом, локальное изменение отброшено")
+                    self._cache.pop(k, None)
+                    self._dirty.discard(k)
+        finally:
+            self._in_flight -= dirty
+
+    async def _flush_loop(self):
+        flushes = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                # Забываем состояния, которые давно не использовались, - при необходимости они перечитаются из БД
+                now = monotonic()
+                for k in [k for k, entry in self._cache.items()
+                          if not self._pending(k) and now - entry[2] > self.cache_ttl]:
+                    del self._cache[k]
+                flushes += 1
+                if flushes % FSM_CLEANUP_EVERY == 0:
+                    await run_db(_delete_expired_fsm_states, datetime.now() - self.state_ttl)
+            except Exception as e:
+                logging.error(f"Ошибка сохранения состояний FSM: {e}")
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+
+dp = Dispatcher(storage=SQLiteStorage())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# ===== Очередь исходящих сообщений =====
+PRIORITY_INTERACTIVE = 0  # Ответы на действия пользователя
+PRIORITY_BULK = 1  # Рассылки и напоминания
+SEND_GLOBAL_RATE = 30  # Сообщений в секунду на всего бота
+SEND_CHAT_RATE = 1  # Сообщений в секунду в один чат
+SEND_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без паузы
+SEND_CONCURRENCY = 8  # Сколько запросов к Bot API выполняется одновременно
+SEND_MAX_RETRIES = 3  # Сколько раз повторять запрос после RetryAfter
+
+# Приоритет запросов, отправленных из текущей задачи
+send_priority = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать до его появления"""
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self):
+        """Сколько секунд ждать до появления токена; сам токен не забирается"""
+        tokens = min(self.capacity, self.tokens + (monotonic() - self.updated) * self.rate)
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def is_idle(self):
+        return self.tokens + (monotonic() - self.updated) * self.rate >= self.capacity
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Очередь запросов к Bot API с приоритетами и ограничением частоты.
+
+    Подключается как middleware сессии бота. Запросы, адресованные в чат,
+    ставятся в очередь своего чата и выполняются SEND_CONCURRENCY воркерами с учетом
+    лимитов Telegram на весь бот и на каждый чат; при RetryAfter отправка
+    приостанавливается и запрос повторяется. Остальные запросы проходят напрямую.
+
+    Воркер берет запрос только из чата, лимит которого уже позволяет отправку, поэтому
+    серия сообщений в один чат не занимает воркеры и не задерживает остальных.
+    """
+
+    def __init__(self, concurrency=SEND_CONCURRENCY, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST):
+        self.concurrency = concurrency
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.stats = {"sent": 0, "failed": 0, "retry_after": 0}
+        self._chats = {}  # chat_id -> куча запросов (приоритет, номер, ...)
+        self._ready = []  # Куча (приоритет, номер, chat_id) чатов, в которые можно отправлять сейчас
+        self._waiting = []  # Куча (когда можно отправлять, chat_id) чатов, ждущих своего лимита
+        self._size = 0
+        self._loop = None
+        self._wakeup = None
+        self._workers = []
+        self._counter = itertools.count()
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Event и воркеры привязаны к циклу событий, а он может смениться (например, между тестами)
+            self._loop, self._wakeup, self._workers = loop, asyncio.Event(), []
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(loop.create_task(self._worker()))
+
+    def queued(self):
+        return self._size
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        self._push((send_priority.get(), next(self._counter), 0, chat_id, make_request, bot, method, future))
+        return await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Забываем чаты, в которые давно ничего не отправляли
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule_chat(self, chat_id):
+        """Ставит чат в _ready или в _waiting в зависимости от его лимита"""
+        items = self._chats[chat_id]
+        delay = self._chat_bucket(chat_id).delay()
+        if delay > 0:
+            heapq.heappush(self._waiting, (monotonic() + delay, chat_id))
+        else:
+            heapq.heappush(self._ready, (items[0][0], items[0][1], chat_id))
+
+    def _push(self, item):
+        chat_id = item[3]
+        self._size += 1
+        items = self._chats.get(chat_id)
+        if items is not None:
+            heapq.heappush(items, item)  # Чат уже в одной из куч
+            return
+        self._chats[chat_id] = [item]
+        self._schedule_chat(chat_id)
+        self._wakeup.set()
+
+    def _pop_ready(self):
+        """Забирает следующий запрос из готового чата или возвращает None"""
+        while self._ready:
+            _, _, chat_id = heapq.heappop(self._ready)
+            items = self._chats[chat_id]
+            item = heapq.heappop(items)
+            self._size -= 1
+            live = not item[-1].done()  # Отмененные запросы выбрасываются, не расходуя лимит
+            if live:
+                self._chat_bucket(chat_id).reserve()
+            if items:
+                self._schedule_chat(chat_id)
+            else:
+                del self._chats[chat_id]
+            if live:
+                return item
+        return None
+
+    async def _next_item(self):
+        while True:
+            now = monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, chat_id = heapq.heappop(self._waiting)
+                self._schedule_chat(chat_id)
+
+            pause = max(self._paused_until - now, self._global_bucket.delay() if self._ready else 0)
+            if pause <= 0:
+                item = self._pop_ready()
+                if item is not None:
+                    self._global_bucket.reserve()
+                    return item
+                continue_at = self._waiting[0][0] if self._waiting else None
+            else:
+                continue_at = now + pause
+
+            self._wakeup.clear()
+            try:
+                timeout = None if continue_at is None else max(continue_at - monotonic(), 0)
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            item = await self._next_item()
+            priority, number, attempt, chat_id, make_request, bot, method, future = item
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                self._paused_until = max(self._paused_until, monotonic() + e.retry_after)
+                if attempt < SEND_MAX_RETRIES:
+                    logging.warning(f"Telegram просит подождать {e.retry_after} с, повторяю запрос")
+                    self._push((priority, number, attempt + 1) + item[3:])
+                    continue
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.stats["sent"] += 1
+                if not future.done():
+                    future.set_result(result)
+
+outbound_queue = OutboundQueue()
+metric(Gauge("bot_outbound_queued", "Запросов в очереди исходящих", collect=outbound_queue.queued))
+metric(Counter("bot_outbound_requests_total", "Итоги отправки через очередь исходящих", "result",
+               collect=lambda: dict(outbound_queue.stats)))
 
 # ===== Клавиатуры =====
 def main_menu_kb():
@@ -114,11 +1526,23 @@ def cancel_kb():
         resize_keyboard=True
     )
 
-def generate_calendar(year=None, month=None):
-    now = datetime.now()
-    if not year: year = now.year
-    if not month: month = now.month
+CALENDAR_CACHE_SIZE = 256  # Сколько готовых клавиатур календаря держать в памяти
 
+def generate_calendar(year=None, month=None, marked_days=frozenset()):
+    """Клавиатура календаря на месяц. Дни из marked_days отмечаются точкой"""
+    today = datetime.now().date()
+    # Дата входит в ключ кэша, поэтому кнопка "Сегодня" обновляется в полночь сама
+    return _build_calendar(year or today.year, month or today.month, today, frozenset(marked_days))
+
+async def user_calendar(user_id, year=None, month=None):
+    """Календарь с отмеченными днями, на которые у пользователя есть события и сроки"""
+    today = datetime.now().date()
+    year, month = year or today.year, month or today.month
+    marked_days = await listing_cache.get(user_id, _get_marked_days, year, month)
+    return generate_calendar(year, month, marked_days)
+
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _build_calendar(year, month, today, marked_days):
     # Создаем заголовок календаря
     month_name = datetime(year, month, 1).strftime('%B %Y')
     keyboard = [
@@ -148,7 +1572,7 @@ def generate_calendar(year=None, month=None):
                 row.append(InlineKeyboardButton(text=" ", callback_data="ignore"))
             else:
                 row.append(InlineKeyboardButton(
-                    text=str(day),
+                    text=f"{day}•" if day in marked_days else str(day),
                     callback_data=f"calendar_day_{year}_{month}_{day}"
                 ))
                 day += 1
@@ -162,7 +1586,7 @@ def generate_calendar(year=None, month=None):
 
     keyboard.append([
         InlineKeyboardButton(text="◀️", callback_data=f"calendar_nav_{prev_year}_{prev_month}"),
-        InlineKeyboardButton(text="Сегодня", callback_data=f"calendar_nav_{now.year}_{now.month}"),
+        InlineKeyboardButton(text="Сегодня", callback_data=f"calendar_nav_{today.year}_{today.month}"),
         InlineKeyboardButton(text="▶️", callback_data=f"calendar_nav_{next_year}_{next_month}")
     ])
 
@@ -183,134 +1607,521 @@ class AddScheduleEvent(StatesGroup):
 class AddMotivation(StatesGroup):
     waiting_for_file = State()
 
-class MarkHomeworkDone(StatesGroup):
-    waiting_for_id = State()
+class ImportData(StatesGroup):
+    waiting_for_file = State()
 
 # Пути к папкам с мотивацией
-MOTIVATION_IMG_DIR = "motivational_content/img"
-MOTIVATION_VIDEO_DIR = "motivational_content/video"
+MOTIVATION_DIR = os.getenv("MOTIVATION_DIR", "motivational_content")
+MOTIVATION_IMG_DIR = f"{MOTIVATION_DIR}/img"
+MOTIVATION_VIDEO_DIR = f"{MOTIVATION_DIR}/video"
+MOTIVATION_USER_QUOTA = 50  # Сколько файлов мотивации может добавить один пользователь
+MOTIVATION_TOTAL_QUOTA = 2 * 1024 ** 3  # Максимальный суммарный размер хранилища в байтах
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class MediaRegistry:
+    """Сохраненные file_id мотивационных файлов: повторно файл отправляется без загрузки с диска"""
+
+    def __init__(self):
+        self._file_ids = None
+
+    async def _ensure_loaded(self):
+        if self._file_ids is None:
+            self._file_ids = await run_db(_get_media_file_ids)
+
+    async def get(self, path):
+        await self._ensure_loaded()
+        return self._file_ids.get(path)
+
+    async def remember(self, path, file_id):
+        await self._ensure_loaded()
+        if self._file_ids.get(path) == file_id:
+            return
+        self._file_ids[path] = file_id
+        await write_db(_save_media_file_id, path, file_id)
+
+    async def forget(self, path):
+        await self._ensure_loaded()
+        if self._file_ids.pop(path, None) is not None:
+            await run_db(_delete_media_file_id, path)
+
+media_registry = MediaRegistry()
+
+MOTIVATION_RESCAN_INTERVAL = 30  # Как часто (в секундах) проверять папки на внешние изменения
+
+class MotivationCatalog:
+    """Список мотивационных файлов в памяти.
+
+    Папки сканируются один раз, новые файлы добавляются через add(), а внешние
+    изменения замечаются по mtime папок не чаще раза в MOTIVATION_RESCAN_INTERVAL секунд.
+    """
+
+    def __init__(self, directories, rescan_interval=MOTIVATION_RESCAN_INTERVAL):
+        self.directories = directories
+        self.rescan_interval = rescan_interval
+        self._files = []
+        self._positions = {}
+        self._mtimes = None
+        self._checked_at = 0.0
+
+    def __len__(self):
+        return len(self._files)
+
+    @staticmethod
+    def _dir_mtime(directory):
+        try:
+            return os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def scan(self):
+        files = []
+        mtimes = {}
+        for directory in self.directories:
+            mtimes[directory] = self._dir_mtime(directory)
+            if mtimes[directory] is None:
+                continue
+            with os.scandir(directory) as entries:
+                files.extend(f"{directory}/{entry.name}" for entry in entries
+                             if entry.is_file() and not entry.name.startswith("."))
+        self._files = files
+        self._positions = {path: i for i, path in enumerate(files)}
+        self._mtimes = mtimes
+        self._checked_at = monotonic()
+
+    def _refresh_if_changed(self):
+        if self._mtimes is None:
+            self.scan()
+            return
+        if monotonic() - self._checked_at < self.rescan_interval:
+            return
+        self._checked_at = monotonic()
+        if any(self._dir_mtime(directory) != mtime for directory, mtime in self._mtimes.items()):
+            logging.info("Папки с мотивацией изменились, обновляю список файлов")
+            self.scan()
+
+    def add(self, path):
+        if self._mtimes is None:
+            self.scan()
+        if path not in self._positions:
+            self._positions[path] = len(self._files)
+            self._files.append(path)
+        directory = os.path.dirname(path)
+        if directory in self._mtimes:
+            self._mtimes[directory] = self._dir_mtime(directory)
+
+    def remove(self, path):
+        position = self._positions.pop(path, None)
+        if position is None:
+            return
+        last = self._files.pop()
+        if last != path:
+            self._files[position] = last
+            self._positions[last] = position
+
+    def choice(self):
+        self._refresh_if_changed()
+        return random.choice(self._files) if self._files else None
+
+motivation_catalog = MotivationCatalog([MOTIVATION_IMG_DIR, MOTIVATION_VIDEO_DIR])
+
+# ===== Обработка картинок мотивации =====
+# Новые картинки уменьшаются, пересжимаются и очищаются от метаданных (EXIF может содержать
+# геопозицию) в отдельных процессах. Нужен Pillow; без него файлы хранятся как есть.
+# GIF и видео не обрабатываются, превью Telegram строит сам
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))  # Процессов обработки, 0 - выключить обработку
+MEDIA_QUEUE_SIZE = 100  # Сколько файлов может ждать обработки; остальные сохраняются без нее
+MEDIA_MAX_SIDE = 1280  # Наибольшая сторона картинки в пикселях, как у фото в Telegram
+MEDIA_JPEG_QUALITY = 85
+
+def _normalize_image(path, max_side, quality):
+    """Выполняется в процессе пула. Возвращает новый размер файла или None, если файл не изменился"""
+    with Image.open(path) as original:
+        image_format = original.format
+        oversized = max(original.size) > max_side
+        has_metadata = bool(original.getexif()) or any(key in original.info for key in ("xmp", "comment"))
+        if not oversized and not has_metadata:
+            return None
+
+        # Поворот из EXIF применяется к пикселям до того, как EXIF будет удален
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        options = {"icc_profile": original.info["icc_profile"]} if "icc_profile" in original.info else {}
+        if image_format == "JPEG":
+            image = image.convert("RGB") if image.mode not in ("RGB", "L") else image
+            options.update(quality=quality, optimize=True, progressive=True)
+        elif image_format == "PNG":
+            options.update(optimize=True)
+
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".normalize_{name}")  # Файлы с точкой каталог не видит
+    image.save(tmp_path, format=image_format, **options)
+    # Уменьшение без метаданных может получиться тяжелее оригинала - тогда он остается
+    if not has_metadata and os.path.getsize(tmp_path) >= os.path.getsize(path):
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+def _mark_media_normalized(db: Session, path, size):
+    """Отмечает картинку обработанной; size - новый размер файла или None, если файл не менялся"""
+    values = {StoredMedia.normalized_at: datetime.now()}
+    if size is not None:
+        values[StoredMedia.size] = size
+    db.query(StoredMedia).filter(StoredMedia.path == path).update(values, synchronize_session=False)
+
+def _get_unnormalized_media(db: Session, directory):
+    return [path for (path,) in db.query(StoredMedia.path)
+            .filter(StoredMedia.normalized_at.is_(None))
+            .filter(StoredMedia.path.startswith(f"{directory}/", autoescape=True))
+            .order_by(StoredMedia.created_at)]
+
+class MediaPipeline:
+    """Очередь картинок на обработку и пул процессов, который ее разбирает.
+
+    Очередь ограничена MEDIA_QUEUE_SIZE: submit() никогда не ждет, и если места нет,
+    файл просто остается необработанным. Обработанные файлы отмечаются в stored_media;
+    необработанные дообрабатывает backfill() по одному, пропуская вперед новые загрузки.
+    Пул создается при первой задаче.
+    """
+
+    def __init__(self, workers=MEDIA_WORKERS, queue_size=MEDIA_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = {"processed": 0, "unchanged": 0, "dropped": 0, "failed": 0}
+        self.bytes_saved = 0
+        self._pool = None
+        self._loop = None
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def enabled(self):
+        return Image is not None and self.workers > 0
+
+    def queued(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Очередь и воркеры привязаны к циклу событий, а он может смениться (например, между тестами).
+            # Картинки из старой очереди обработает backfill при следующем запуске
+            self._loop, self._queue, self._tasks = loop, asyncio.Queue(maxsize=self.queue_size), []
+        if self._pool is None:
+            # spawn, а не fork: в процессе бота уже работают потоки БД
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._worker()))
+
+    def submit(self, path):
+        """Ставит картинку в очередь. Возвращает False, если обработка выключена или очередь заполнена"""
+        if not self.enabled:
+            return False
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait(path)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logging.warning(f"Очередь обработки картинок заполнена, {path} сохранен без обработки")
+            return False
+        return True
+
+    async def backfill(self, directory):
+        """Обрабатывает картинки из directory, которые еще не обрабатывались.
+
+        Файлы идут мимо очереди загрузок, по одному и только когда она пуста,
+        поэтому занимают не больше одного процесса и не вытесняют новые загрузки.
+        """
+        if not self.enabled:
+            return
+        self._ensure_workers()
+        for path in await run_db(_get_unnormalized_media, directory):
+            await self._queue.join()
+            if os.path.exists(path):
+                await self._process(path)
+
+    async def _process(self, path):
+        try:
+            size_before = os.path.getsize(path)
+            size = await asyncio.get_running_loop().run_in_executor(self._pool, _normalize_image, path,
+                                                                    MEDIA_MAX_SIDE, MEDIA_JPEG_QUALITY)
+            if size is None:
+                self.stats["unchanged"] += 1
+            else:
+                self.stats["processed"] += 1
+                self.bytes_saved += size_before - size
+            await write_db(_mark_media_normalized, path, size)
+        except Exception as e:
+            self.stats["failed"] += 1
+            logging.error(f"Ошибка обработки картинки {path}: {e}")
+
+    async def _worker(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                await self._process(path)
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+media_pipeline = MediaPipeline()
+metric(Gauge("bot_media_queued", "Картинок в очереди обработки", collect=media_pipeline.queued))
+metric(Counter("bot_media_jobs_total", "Итоги обработки картинок", "result", collect=lambda: dict(media_pipeline.stats)))
+metric(Counter("bot_media_bytes_saved_total", "Сколько байт сэкономила обработка картинок",
+               collect=lambda: media_pipeline.bytes_saved))
+
+# ===== Роутеры =====
+# Обработчики разделены по подсистемам. Кнопки reply-клавиатуры, на которые приходится
+# почти весь трафик, не проверяются фильтрами по одной: у каждого роутера первым стоит
+# обработчик, который ищет кнопку по точному тексту в словаре роутера
+MENU_BUTTON_TEXTS = set()  # Тексты кнопок всех MenuRouter
+
+class MenuRouter(Router):
+    """Router подсистемы, в котором обработчики кнопок регистрируются по тексту кнопки.
+
+    Кнопка ищется первым обработчиком роутера и срабатывает в любом состоянии диалога.
+    Кнопки других роутеров этот роутер пропускает целиком, чтобы их не перехватили его
+    обработчики состояний. Обработчик кнопки выполняется внутри своего роутера, поэтому
+    middleware и фильтры роутера на него действуют.
+    """
+
+    def __init__(self, *, name=None):
+        super().__init__(name=name)
+        self.buttons = {}  # Текст кнопки -> (обработчик, имена его параметров)
+        self.message.filter(self._is_not_foreign_button)
+        self.message.register(self._dispatch_button, self._match_button)
+
+    def button(self, *texts):
+        def register(callback):
+            parameters = set(inspect.signature(callback).parameters)
+            for label in texts:
+                if label in MENU_BUTTON_TEXTS:
+                    raise ValueError(f"Кнопка {label!r} уже обрабатывается")
+                MENU_BUTTON_TEXTS.add(label)
+                self.buttons[label] = callback, parameters
+            return callback
+        return register
+
+    def _is_not_foreign_button(self, message: types.Message):
+        return message.text not in MENU_BUTTON_TEXTS or message.text in self.buttons
+
+    def _match_button(self, message: types.Message):
+        button = self.buttons.get(message.text)
+        return {"menu_callback": button[0]} if button else False
+
+    async def _dispatch_button(self, message: types.Message, menu_callback, **data):
+        _, parameters = self.buttons[message.text]
+        return await menu_callback(message, **{name: value for name, value in data.items() if name in parameters})
+
+main_router = MenuRouter(name="main")
+motivation_router = MenuRouter(name="motivation")
+calendar_router = MenuRouter(name="calendar")
+homework_router = MenuRouter(name="homework")
+schedule_router = MenuRouter(name="schedule")
+transfer_router = MenuRouter(name="import_export")
+dp.include_routers(main_router, motivation_router, calendar_router, homework_router, schedule_router,
+                   transfer_router)
 
 # ===== Обработчики команд =====
-@dp.message(Command("start"))
+@main_router.message(Command("start"))
 async def start(message: types.Message):
     await message.answer(
         "Привет! Я твой школьный органайзер. Что хочешь сделать?",
         reply_markup=main_menu_kb()
     )
 
-@dp.message(F.text == "📚 Домашние задания")
+@homework_router.button("📚 Домашние задания")
 async def homework_menu(message: types.Message):
     await message.answer(
         "Меню домашних заданий:",
         reply_markup=homework_menu_kb()
     )
 
-@dp.message(F.text == "📅 Расписание")
+@schedule_router.button("📅 Расписание")
 async def schedule_menu(message: types.Message):
     await message.answer(
         "Меню расписания:",
         reply_markup=schedule_menu_kb()
     )
 
-@dp.message(F.text == "💡 Мотивация")
+@motivation_router.button("💡 Мотивация")
 async def motivation_from_button(message: types.Message):
     await send_motivation(message)
 
-@dp.message(F.text == "➕ Добавить мотивацию")
+@motivation_router.button("➕ Добавить мотивацию")
 async def ask_for_motivation_upload(message: types.Message, state: FSMContext):
     await message.answer("Пришли мне картинку, GIF или видео, которые ты хочешь добавить как мотивацию.")
     await state.set_state(AddMotivation.waiting_for_file)
 
-@dp.message(AddMotivation.waiting_for_file)
+@motivation_router.message(AddMotivation.waiting_for_file)
 async def receive_motivation_file(message: types.Message, state: FSMContext):
     try:
-        file = None
-        file_path = ""
-
         if message.photo:
-            file = await bot.get_file(message.photo[-1].file_id)
-            file_path = f"{MOTIVATION_IMG_DIR}/user_{message.from_user.id}_{file.file_unique_id}.jpg"
+            media = message.photo[-1]
+            directory, extension = MOTIVATION_IMG_DIR, ".jpg"
         elif message.video:
-            file = await bot.get_file(message.video.file_id)
-            file_path = f"{MOTIVATION_VIDEO_DIR}/user_{message.from_user.id}_{file.file_unique_id}.mp4"
+            media = message.video
+            directory, extension = MOTIVATION_VIDEO_DIR, ".mp4"
         elif message.animation:  # Это обработка GIF
-            file = await bot.get_file(message.animation.file_id)
-            file_path = f"{MOTIVATION_VIDEO_DIR}/user_{message.from_user.id}_{file.file_unique_id}.gif"
+            media = message.animation
+            directory, extension = MOTIVATION_VIDEO_DIR, ".gif"
         else:
             await message.answer("Пожалуйста, отправь картинку, GIF или видео.")
             return
 
+        # Этот файл уже присылали - скачивать его еще раз не нужно
+        if await run_db(_find_media_by_unique_id, media.file_unique_id):
+            await message.answer("✅ Такая мотивация уже есть, спасибо!", reply_markup=main_menu_kb())
+            return
+
+        quota_error = await run_db(_check_media_quota, message.from_user.id, media.file_size or 0)
+        if quota_error == "user":
+            await message.answer(f"❌ Можно добавить не больше {MOTIVATION_USER_QUOTA} файлов мотивации.",
+                                 reply_markup=main_menu_kb())
+            return
+        elif quota_error == "total":
+            await message.answer("❌ Хранилище мотивации заполнено, попробуй позже.", reply_markup=main_menu_kb())
+            return
+
         # Создаем папки если их нет
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        await bot.download_file(file.file_path, destination=file_path)
-        await message.answer("✅ Мотивация добавлена! Спасибо!", reply_markup=main_menu_kb())
+        os.makedirs(directory, exist_ok=True)
+        file = await bot.get_file(media.file_id)
+        # Уникальное имя: один и тот же файл могут загружать одновременно. Точка в начале - чтобы каталог его не видел
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload_", dir=directory)
+        os.close(fd)
+        try:
+            await bot.download_file(file.file_path, destination=tmp_path)
+
+            # Один и тот же файл может прийти с разными file_unique_id, поэтому сверяем содержимое
+            sha256 = await asyncio.to_thread(_hash_file, tmp_path)
+            file_path, is_new = await run_db(_register_media, sha256, f"{directory}/{sha256[:32]}{extension}",
+                                             os.path.getsize(tmp_path), message.from_user.id, media.file_unique_id)
+            if is_new:
+                os.replace(tmp_path, file_path)
+        finally:
+            # После os.replace файла уже нет, в остальных случаях (дубликат или ошибка) удаляем его
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if is_new:
+            motivation_catalog.add(file_path)
+            if directory == MOTIVATION_IMG_DIR:
+                media_pipeline.submit(file_path)
+            # Этот file_id уже можно использовать для отправки без повторной загрузки
+            await media_registry.remember(file_path, media.file_id)
+            await message.answer("✅ Мотивация добавлена! Спасибо!", reply_markup=main_menu_kb())
+        else:
+            await message.answer("✅ Такая мотивация уже есть, спасибо!", reply_markup=main_menu_kb())
     except Exception as e:
         logging.error(f"Ошибка при получении мотивации: {e}")
         await message.answer("❌ Ошибка при загрузке файла.")
     finally:
         await state.clear()
 
-@dp.message(Command("motivate"))
-async def send_motivation(message: types.Message):
-    try:
-        # Получаем все доступные файлы
-        all_files = []
-        if os.path.exists(MOTIVATION_IMG_DIR):
-            all_files.extend([("img", f) for f in os.listdir(MOTIVATION_IMG_DIR)])
-        if os.path.exists(MOTIVATION_VIDEO_DIR):
-            all_files.extend([("video", f) for f in os.listdir(MOTIVATION_VIDEO_DIR)])
-
-        if not all_files:
-            await message.answer("Мотивационные материалы скоро добавятся!")
-            return
+async def send_random_motivation(chat_id, reply_to_message_id=None):
+    """Отправляет в чат случайный мотивационный файл. Возвращает False, если файлов нет"""
+    # Выбираем случайный файл
+    file_path = motivation_catalog.choice()
+    if file_path is None:
+        return False
 
-        # Выбираем случайный файл
-        content_type, filename = random.choice(all_files)
-        file_path = f"{MOTIVATION_IMG_DIR if content_type == 'img' else MOTIVATION_VIDEO_DIR}/{filename}"
+    if file_path.startswith(MOTIVATION_IMG_DIR):
+        kind = "img"
+    else:
+        kind = "gif" if file_path.lower().endswith('.gif') else "video"
 
-        if content_type == "img":
-            await message.reply_photo(
-                FSInputFile(file_path),
-                caption="💪 Ты справишься! Вот мотивация для тебя!"
-            )
-        else:
-            # Для видео и GIF
-            if filename.lower().endswith('.gif'):
-                await message.reply_animation(
-                    FSInputFile(file_path),
-                    caption="🎬 Держи мотивирующую GIFку!"
-                )
-            else:
-                await message.reply_video(
-                    FSInputFile(file_path),
-                    caption="🔥 Время показать, на что ты способен!"
-                )
+    file_id = await media_registry.get(file_path)
+    if file_id:
+        try:
+            await _send_motivation_media(chat_id, kind, file_id, reply_to_message_id)
+            return True
+        except TelegramBadRequest as e:
+            logging.warning(f"Сохраненный file_id для {file_path} не подошел: {e}")
+            await media_registry.forget(file_path)
+
+    if not os.path.exists(file_path):
+        # Файл удалили с диска, а список еще не обновился
+        motivation_catalog.remove(file_path)
+        return await send_random_motivation(chat_id, reply_to_message_id)
+
+    file_id = await _send_motivation_media(chat_id, kind, FSInputFile(file_path), reply_to_message_id)
+    await media_registry.remember(file_path, file_id)
+    return True
+
+async def _send_motivation_media(chat_id, kind, media, reply_to_message_id=None):
+    """Отправляет файл (file_id или FSInputFile) и возвращает его file_id на серверах Telegram"""
+    if kind == "img":
+        sent = await bot.send_photo(
+            chat_id,
+            media,
+            caption="💪 Ты справишься! Вот мотивация для тебя!",
+            reply_to_message_id=reply_to_message_id
+        )
+        return sent.photo[-1].file_id
+    elif kind == "gif":
+        sent = await bot.send_animation(
+            chat_id,
+            media,
+            caption="🎬 Держи мотивирующую GIFку!",
+            reply_to_message_id=reply_to_message_id
+        )
+        return sent.animation.file_id
+    else:
+        sent = await bot.send_video(
+            chat_id,
+            media,
+            caption="🔥 Время показать, на что ты способен!",
+            reply_to_message_id=reply_to_message_id
+        )
+        return sent.video.file_id
 
+@motivation_router.message(Command("motivate"))
+async def send_motivation(message: types.Message):
+    try:
+        if not await send_random_motivation(message.chat.id, message.message_id):
+            await message.answer("Мотивационные материалы скоро добавятся!")
     except Exception as e:
         logging.error(f"Ошибка отправки мотивации: {e}")
         await message.answer("Что-то пошло не так 😢")
 
-@dp.message(F.text == "Календарь")
+@calendar_router.button("Календарь")
 async def show_calendar(message: types.Message):
     await message.answer(
         "Выбери дату:",
-        reply_markup=generate_calendar()
+        reply_markup=await user_calendar(message.from_user.id)
     )
 
-@dp.message(F.text == "Назад")
+@main_router.button("Назад")
 async def go_back_to_main_menu(message: types.Message):
     await message.answer("Возвращаюсь в главное меню:", reply_markup=main_menu_kb())
 
-@dp.callback_query(F.data.startswith("calendar_nav_"))
+@calendar_router.callback_query(F.data.startswith("calendar_nav_"))
 async def calendar_navigation(callback: types.CallbackQuery):
     _, _, year, month = callback.data.split("_")
     await callback.message.edit_reply_markup(
-        reply_markup=generate_calendar(int(year), int(month))
+        reply_markup=await user_calendar(callback.from_user.id, int(year), int(month))
     )
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("calendar_day_"))
+@calendar_router.callback_query(F.data.startswith("calendar_day_"))
 async def select_date(callback: types.CallbackQuery, state: FSMContext):
     _, _, year, month, day = callback.data.split("_")
     selected_date = datetime(int(year), int(month), int(day))
@@ -337,7 +2148,7 @@ async def select_date(callback: types.CallbackQuery, state: FSMContext):
 
     await callback.answer(f"Выбрана дата: {day}.{month}.{year}")
 
-@dp.message(F.text == "Добавить событие")
+@schedule_router.button("Добавить событие")
 async def add_schedule_event_start(message: types.Message, state: FSMContext):
     await message.answer("Выберите дату события (или нажмите 'Календарь'):",
                          reply_markup=ReplyKeyboardMarkup(
@@ -350,17 +2161,13 @@ async def add_schedule_event_start(message: types.Message, state: FSMContext):
     await state.set_state(AddScheduleEvent.date)
 
 # ===== Обработчики для домашних заданий =====
-@dp.message(F.text == "Добавить задание")
+@homework_router.button("Добавить задание")
 async def add_homework_start(message: types.Message, state: FSMContext):
     await message.answer("Выберите предмет:", reply_markup=subjects_kb())
     await state.set_state(AddHomework.subject)
 
-@dp.message(AddHomework.subject)
+@homework_router.message(AddHomework.subject)
 async def select_homework_subject(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-
     if message.text not in SUBJECTS:
         await message.answer("Пожалуйста, выберите предмет из списка:")
         return
@@ -378,15 +2185,8 @@ async def select_homework_subject(message: types.Message, state: FSMContext):
     )
     await state.set_state(AddHomework.deadline)
 
-@dp.message(AddHomework.deadline)
+@homework_router.message(AddHomework.deadline)
 async def select_homework_deadline(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-    elif message.text == "Календарь":
-        await message.answer("Выберите дату выполнения:", reply_markup=generate_calendar())
-        return
-
     try:
         deadline = datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(deadline=deadline)
@@ -395,25 +2195,14 @@ async def select_homework_deadline(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или выберите из календаря")
 
-@dp.message(AddHomework.task)
+@homework_router.message(AddHomework.task)
 async def save_homework(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-
     data = await state.get_data()
     task = message.text
 
-    db = SessionLocal()
     try:
-        homework = Homework(
-            user_id=message.from_user.id,
-            subject=data['subject'],
-            task=task,
-            deadline=data.get('deadline')
-        )
-        db.add(homework)
-        db.commit()
+        await write_user_db(_add_homework, message.from_user.id, data['subject'], task, data.get('deadline'))
+        await listing_cache.invalidate(message.from_user.id)
 
         response = (f"✅ Домашнее задание добавлено!\n\n"
                     f"📚 Предмет: {data['subject']}\n"
@@ -426,170 +2215,326 @@ async def save_homework(message: types.Message, state: FSMContext):
 
         await message.answer(response, reply_markup=homework_menu_kb())
     except Exception as e:
-        db.rollback()
         await message.answer("❌ Ошибка при сохранении задания", reply_markup=homework_menu_kb())
         logging.error(f"Error saving homework: {e}")
     finally:
-        db.close()
         await state.clear()
 
-@dp.message(F.text == "Мои задания")
-async def show_homeworks(message: types.Message):
-    db = SessionLocal()
-    try:
-        homeworks = db.query(Homework) \
-            .filter(Homework.user_id == message.from_user.id) \
-            .filter(Homework.is_done == False) \
-            .order_by(Homework.deadline.asc() if Homework.deadline is not None else Homework.created_at.asc()) \
-            .all()
+# ===== Длинные ответы =====
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина сообщения в UTF-16 символах
+
+def utf16_len(text):
+    """Длина текста так, как ее считает Telegram (эмодзи вне BMP занимают 2 символа)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _split_long_part(text, limit):
+    """Разбивает часть длиннее limit, по возможности по переносам строк"""
+    pieces = []
+    while utf16_len(text) > limit:
+        cut, units = 0, 0
+        for char in text:
+            units += 2 if ord(char) > 0xFFFF else 1
+            if units > limit:
+                break
+            cut += 1
+        newline = text.rfind("\n", 0, cut)
+        if newline > 0:
+            cut = newline
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        pieces.append(text)
+    return pieces
+
+def pack_messages(parts, limit=TELEGRAM_MESSAGE_LIMIT, separator="\n"):
+    """Склеивает части ответа в как можно меньшее число сообщений не длиннее limit.
+
+    Части не разрываются между сообщениями, если только одна часть сама не длиннее limit.
+    """
+    messages = []
+    current, current_len = [], 0
+    separator_len = utf16_len(separator)
+    for part in parts:
+        for piece in _split_long_part(part, limit):
+            piece_len = utf16_len(piece)
+            if current and current_len + separator_len + piece_len > limit:
+                messages.append(separator.join(current))
+                current, current_len = [], 0
+            current_len += piece_len + (separator_len if current else 0)
+            current.append(piece)
+    if current:
+        messages.append(separator.join(current))
+    return messages
+
+async def answer_packed(message: types.Message, parts, reply_markup=None):
+    """Отправляет части ответа минимальным числом сообщений; клавиатура - у последнего"""
+    messages = pack_messages(parts)
+    for i, chunk in enumerate(messages):
+        await message.answer(chunk, reply_markup=reply_markup if i == len(messages) - 1 else None)
+
+# ===== Постраничные списки =====
+# Курсор страницы - ключ сортировки первой или последней записи: (дата, id).
+# Он передается в callback_data кнопок ◀️/▶️, поэтому запрос страницы не зависит от ее номера.
+def _encode_cursor(value, row_id):
+    return f"{value.strftime('%Y%m%d%H%M%S') if value else 'n'}_{row_id}"
+
+def _decode_cursor(value, row_id):
+    return (None if value == "n" else datetime.strptime(value, "%Y%m%d%H%M%S")), int(row_id)
+
+def _page_keyboard(prefix, first_cursor, last_cursor, direction, has_more):
+    """Кнопки ◀️/▶️ для страницы, полученной в направлении direction"""
+    has_prev = direction == "next" or (direction == "prev" and has_more)
+    has_next = direction == "prev" or (direction != "prev" and has_more)
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"{prefix}_prev_{_encode_cursor(*first_cursor)}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"{prefix}_next_{_encode_cursor(*last_cursor)}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+def _format_active_homework(hw, now):
+    if hw.deadline:
+        time_left = hw.deadline - now
+        total_seconds = int(time_left.total_seconds())
+
+        if total_seconds <= 0:
+            time_passed = -total_seconds
+            days_passed = time_passed // 86400
+            hours_passed = (time_passed % 86400) // 3600
+            deadline_str = f"⌛️ Просрочено: {days_passed}д {hours_passed}ч"
+        else:
+            days_left = total_seconds // 86400
+            hours_left = (total_seconds % 86400) // 3600
+            deadline_str = f"⏳ Осталось: {days_left}д {hours_left}ч"
+    else:
+        deadline_str = "🕰 Без срока"
 
-        if not homeworks:
-            await message.answer("У вас нет активных домашних заданий")
-            return
+    return (
+        f"\n📌 {hw.subject}\n"
+        f"📝 {hw.task[:50]}{'...' if len(hw.task) > 50 else ''}\n"
+        f"{deadline_str}"
+    )
 
-        response = ["📚 Ваши домашние задания:"]
-        now = datetime.now()
+def _format_completed_homework(hw):
+    deadline_str = f"до {hw.deadline.strftime('%d.%m.%Y')}" if hw.deadline else "без срока"
+    return (
+        f"\n📌 {hw.subject}\n"
+        f"📝 {hw.task[:50]}{'...' if len(hw.task) > 50 else ''}\n"
+        f"⏳ {deadline_str}"
+    )
 
-        for hw in homeworks:
-            if hw.deadline:
-                time_left = hw.deadline - now
-                total_seconds = int(time_left.total_seconds())
+def _format_event(event):
+    return (
+        f"\n📌 {event.event_date.strftime('%d.%m.%Y')}\n"
+        f"📚 {event.subject} - {event.event_type}\n"
+        f"📄 {event.description if event.description else 'без описания'}"
+    )
 
-                if total_seconds <= 0:
-                    time_passed = -total_seconds
-                    days_passed = time_passed // 86400
-                    hours_passed = (time_passed % 86400) // 3600
-                    deadline_str = f"⌛️ Просрочено: {days_passed}д {hours_passed}ч"
-                else:
-                    days_left = total_seconds // 86400
-                    hours_left = (total_seconds % 86400) // 3600
-                    deadline_str = f"⏳ Осталось: {days_left}д {hours_left}ч"
-            else:
-                deadline_str = "🕰 Без срока"
+async def homework_page(user_id, is_done, direction=None, cursor=None):
+    """Текст и клавиатура страницы активных или завершенных заданий. None, если страница пуста"""
+    homeworks, has_more = await listing_cache.get(user_id, _get_homework_page, is_done, direction, cursor)
+    if not homeworks:
+        return None
 
-            response.append(
-                f"\n📌 {hw.subject}\n"
-                f"📝 {hw.task[:50]}{'...' if len(hw.task) > 50 else ''}\n"
-                f"{deadline_str}"
-            )
+    if is_done:
+        response = ["✅ Завершенные задания:"] + [_format_completed_homework(hw) for hw in homeworks]
+    else:
+        now = datetime.now()
+        response = ["📚 Ваши домашние задания:"] + [_format_active_homework(hw, now) for hw in homeworks]
+
+    keyboard = _page_keyboard(f"hw_page_{int(is_done)}", (homeworks[0].deadline, homeworks[0].id),
+                              (homeworks[-1].deadline, homeworks[-1].id), direction, has_more)
+    return "\n".join(response), keyboard
+
+async def event_page(user_id, direction=None, cursor=None):
+    """Текст и клавиатура страницы ближайших событий. None, если страница пуста"""
+    # Берем события начиная с сегодняшнего дня
+    today = datetime.now().date()
+    events, has_more = await listing_cache.get(user_id, _get_event_page, today, direction, cursor)
+    if not events:
+        return None
+
+    response = ["📅 Ваши ближайшие события:"] + [_format_event(event) for event in events]
+    keyboard = _page_keyboard("ev_page", (events[0].event_date, events[0].id),
+                              (events[-1].event_date, events[-1].id), direction, has_more)
+    return "\n".join(response), keyboard
+
+@homework_router.button("Мои задания")
+async def show_homeworks(message: types.Message):
+    try:
+        page = await homework_page(message.from_user.id, False)
+        if not page:
+            await message.answer("У вас нет активных домашних заданий")
+            return
 
-        for i in range(0, len(response), 5):
-            await message.answer("\n".join(response[i:i + 5]))
+        text, keyboard = page
+        await message.answer(text, reply_markup=keyboard)
 
     except Exception as e:
         await message.answer("❌ Ошибка при получении заданий")
         logging.error(f"Error getting homeworks: {e}")
-    finally:
-        db.close()
 
-@dp.message(F.text == "Завершенные")
+@homework_router.button("Завершенные")
 async def show_completed_homeworks(message: types.Message):
-    db = SessionLocal()
     try:
-        homeworks = db.query(Homework) \
-            .filter(Homework.user_id == message.from_user.id) \
-            .filter(Homework.is_done == True) \
-            .order_by(Homework.deadline.asc() if Homework.deadline is not None else Homework.created_at.asc()) \
-            .all()
-
-        if not homeworks:
+        page = await homework_page(message.from_user.id, True)
+        if not page:
             await message.answer("У вас нет завершенных домашних заданий")
             return
 
-        response = ["✅ Завершенные задания:"]
-        for hw in homeworks:
-            deadline_str = f"до {hw.deadline.strftime('%d.%m.%Y')}" if hw.deadline else "без срока"
-            response.append(
-                f"\n📌 {hw.subject}\n"
-                f"📝 {hw.task[:50]}{'...' if len(hw.task) > 50 else ''}\n"
-                f"⏳ {deadline_str}"
-            )
-
-        for i in range(0, len(response), 5):
-            await message.answer("\n".join(response[i:i + 5]))
+        text, keyboard = page
+        await message.answer(text, reply_markup=keyboard)
 
     except Exception as e:
         await message.answer("❌ Ошибка при получении заданий")
         logging.error(f"Error getting homeworks: {e}")
-    finally:
-        db.close()
 
-@dp.message(F.text == "Отметить выполнение")
-async def mark_as_done_start(message: types.Message, state: FSMContext):
-    db = SessionLocal()
-    try:
-        homeworks = db.query(Homework) \
-            .filter(Homework.user_id == message.from_user.id) \
-            .filter(Homework.is_done == False) \
-            .order_by(Homework.deadline.asc() if Homework.deadline is not None else Homework.created_at.asc()) \
-            .all()
+@homework_router.callback_query(F.data.startswith("hw_page_"))
+async def homework_page_navigation(callback: types.CallbackQuery):
+    _, _, is_done, direction, value, row_id = callback.data.split("_")
+    page = await homework_page(callback.from_user.id, is_done == "1", direction, _decode_cursor(value, row_id))
+    if not page:
+        await callback.answer("Здесь больше ничего нет")
+        return
 
-        if not homeworks:
-            await message.answer("У вас нет активных заданий для отметки")
-            return
+    text, keyboard = page
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
-        response = ["📝 Выберите номер задания для отметки как выполненное:\n"]
-        for i, hw in enumerate(homeworks, 1):
-            deadline_str = f"до {hw.deadline.strftime('%d.%m.%Y')}" if hw.deadline else "без срока"
-            response.append(
-                f"{i}. {hw.subject}: {hw.task[:50]}{'...' if len(hw.task) > 50 else ''} ({deadline_str})"
-            )
+# Задания отмечаются inline-кнопками с id задания. В режиме "несколько" выбор хранится
+# прямо в клавиатуре сообщения (☑️/⬜), поэтому отдельное состояние FSM не нужно.
+def _homework_label(hw):
+    deadline_str = f"до {hw.deadline.strftime('%d.%m.%Y')}" if hw.deadline else "без срока"
+    return f"{hw.subject}: {hw.task[:30]}{'...' if len(hw.task) > 30 else ''} ({deadline_str})"
+
+def _homework_button_id(button):
+    return int(button.callback_data.rsplit("_", 1)[1])
+
+async def done_picker_page(user_id, direction=None, cursor=None):
+    """Страница активных заданий с кнопкой "выполнено" у каждого. None, если заданий нет"""
+    homeworks, has_more = await listing_cache.get(user_id, _get_homework_page, False, direction, cursor)
+    if not homeworks:
+        return None
+
+    keyboard = [[InlineKeyboardButton(text=f"✅ {_homework_label(hw)}", callback_data=f"hw_done_{hw.id}")]
+                for hw in homeworks]
+    navigation = _page_keyboard("hw_pick", (homeworks[0].deadline, homeworks[0].id),
+                                (homeworks[-1].deadline, homeworks[-1].id), direction, has_more)
+    if navigation:
+        keyboard += navigation.inline_keyboard
+    keyboard.append([InlineKeyboardButton(text="☑️ Отметить несколько", callback_data="hw_multi")])
+    return "📝 Нажмите на задание, чтобы отметить его выполненным:", InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def _show_done_picker(callback: types.CallbackQuery):
+    """Перерисовывает сообщение с первой страницей активных заданий"""
+    page = await done_picker_page(callback.from_user.id)
+    if page:
+        text, keyboard = page
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    else:
+        await callback.message.edit_text("🎉 Все задания выполнены!")
 
-        response.append("\nНапишите номер задания, которое вы выполнили:")
+@homework_router.button("Отметить выполнение")
+async def mark_as_done_start(message: types.Message):
+    try:
+        page = await done_picker_page(message.from_user.id)
+        if not page:
+            await message.answer("У вас нет активных заданий для отметки")
+            return
 
-        await message.answer("\n".join(response), reply_markup=ReplyKeyboardRemove())
-        await state.update_data(homeworks=[hw.id for hw in homeworks])
-        await state.set_state(MarkHomeworkDone.waiting_for_id)
+        text, keyboard = page
+        await message.answer(text, reply_markup=keyboard)
 
     except Exception as e:
         await message.answer("❌ Ошибка при получении заданий")
         logging.error(f"Error getting homeworks: {e}")
-    finally:
-        db.close()
 
-@dp.message(MarkHomeworkDone.waiting_for_id)
-async def mark_homework_done(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await state.clear()
-        await message.answer("Действие отменено", reply_markup=homework_menu_kb())
+@homework_router.callback_query(F.data.startswith("hw_pick_"))
+async def done_picker_navigation(callback: types.CallbackQuery):
+    _, _, direction, value, row_id = callback.data.split("_")
+    page = await done_picker_page(callback.from_user.id, direction, _decode_cursor(value, row_id))
+    if not page:
+        await callback.answer("Здесь больше ничего нет")
         return
 
+    text, keyboard = page
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@homework_router.callback_query(F.data.startswith("hw_done_"))
+async def mark_homework_done(callback: types.CallbackQuery):
+    homework_id = int(callback.data.rsplit("_", 1)[1])
     try:
-        task_num = int(message.text)
-        data = await state.get_data()
-        homeworks_ids = data.get('homeworks', [])
+        updated = await write_user_db(_mark_homeworks_done, callback.from_user.id, [homework_id])
+        await listing_cache.invalidate(callback.from_user.id)
+    except Exception as e:
+        await callback.answer("❌ Ошибка при обновлении задания")
+        logging.error(f"Error updating homework: {e}")
+        return
 
-        if task_num < 1 or task_num > len(homeworks_ids):
-            await message.answer("Пожалуйста, введите корректный номер задания")
-            return
+    await callback.answer("✅ Задание отмечено как выполненное!" if updated else "❌ Задание не найдено")
+    # Убираем кнопку задания из текущей страницы, не перечитывая список
+    rows = [row for row in callback.message.reply_markup.inline_keyboard
+            if row[0].callback_data != callback.data]
+    if any(row[0].callback_data.startswith("hw_done_") for row in rows):
+        await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    else:
+        await _show_done_picker(callback)
 
-        homework_id = homeworks_ids[task_num - 1]
+@homework_router.callback_query(F.data == "hw_multi")
+async def select_several_homeworks(callback: types.CallbackQuery):
+    keyboard = [
+        [InlineKeyboardButton(text=f"⬜ {row[0].text.split(' ', 1)[1]}",
+                              callback_data=f"hw_sel_{_homework_button_id(row[0])}")]
+        for row in callback.message.reply_markup.inline_keyboard if row[0].callback_data.startswith("hw_done_")
+    ]
+    keyboard.append([
+        InlineKeyboardButton(text="✅ Отметить выбранные", callback_data="hw_sel_done"),
+        InlineKeyboardButton(text="↩️ Назад", callback_data="hw_sel_back"),
+    ])
+    await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer("Выберите задания и нажмите \"Отметить выбранные\"")
 
-        db = SessionLocal()
-        try:
-            homework = db.query(Homework).filter(Homework.id == homework_id).first()
-            if homework:
-                homework.is_done = True
-                db.commit()
-                await message.answer(f"✅ Задание '{homework.subject}' отмечено как выполненное!",
-                                   reply_markup=homework_menu_kb())
-            else:
-                await message.answer("❌ Задание не найдено", reply_markup=homework_menu_kb())
-        except Exception as e:
-            db.rollback()
-            await message.answer("❌ Ошибка при обновлении задания", reply_markup=homework_menu_kb())
-            logging.error(f"Error updating homework: {e}")
-        finally:
-            db.close()
+@homework_router.callback_query(F.data == "hw_sel_back")
+async def cancel_homework_selection(callback: types.CallbackQuery):
+    await _show_done_picker(callback)
+    await callback.answer()
 
-    except ValueError:
-        await message.answer("Пожалуйста, введите номер задания цифрами")
+@homework_router.callback_query(F.data == "hw_sel_done")
+async def mark_selected_homeworks_done(callback: types.CallbackQuery):
+    homework_ids = [_homework_button_id(row[0]) for row in callback.message.reply_markup.inline_keyboard
+                    if row[0].callback_data.startswith("hw_sel_") and row[0].text.startswith("☑️")]
+    if not homework_ids:
+        await callback.answer("Сначала выберите задания")
         return
 
-    await state.clear()
+    try:
+        updated = await write_user_db(_mark_homeworks_done, callback.from_user.id, homework_ids)
+        await listing_cache.invalidate(callback.from_user.id)
+    except Exception as e:
+        await callback.answer("❌ Ошибка при обновлении заданий")
+        logging.error(f"Error updating homeworks: {e}")
+        return
+
+    await callback.answer(f"✅ Отмечено выполненными: {updated}")
+    await _show_done_picker(callback)
+
+@homework_router.callback_query(F.data.startswith("hw_sel_"))
+async def toggle_homework_selection(callback: types.CallbackQuery):
+    keyboard = []
+    for row in callback.message.reply_markup.inline_keyboard:
+        button = row[0]
+        if button.callback_data == callback.data:
+            mark, label = button.text.split(" ", 1)
+            button = InlineKeyboardButton(text=f"{'⬜' if mark == '☑️' else '☑️'} {label}",
+                                          callback_data=button.callback_data)
+            row = [button]
+        keyboard.append(row)
+    await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer()
 
-@dp.message(Command("cancel"))
-@dp.message(F.text == "❌ Отмена")
+@main_router.message(Command("cancel"))
+@main_router.button("❌ Отмена")
 async def cancel_handler(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state is None:
@@ -599,18 +2544,13 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     await state.clear()
     if current_state.startswith("AddHomework"):
         await message.answer("Действие отменено", reply_markup=homework_menu_kb())
-    else:
+    elif current_state.startswith("AddScheduleEvent"):
         await message.answer("Действие отменено", reply_markup=schedule_menu_kb())
+    else:
+        await message.answer("Действие отменено", reply_markup=main_menu_kb())
 
-@dp.message(AddScheduleEvent.date)
+@schedule_router.message(AddScheduleEvent.date)
 async def select_event_date(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-    elif message.text == "Календарь":
-        await message.answer("Выберите дату:", reply_markup=generate_calendar())
-        return
-
     try:
         event_date = datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(date=event_date)
@@ -619,12 +2559,8 @@ async def select_event_date(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или выберите из календаря.")
 
-@dp.message(AddScheduleEvent.subject)
+@schedule_router.message(AddScheduleEvent.subject)
 async def select_subject(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-
     if message.text not in SUBJECTS:
         await message.answer("Пожалуйста, выберите предмет из списка:")
         return
@@ -636,12 +2572,8 @@ async def select_subject(message: types.Message, state: FSMContext):
     )
     await state.set_state(AddScheduleEvent.event_type)
 
-@dp.message(AddScheduleEvent.event_type)
+@schedule_router.message(AddScheduleEvent.event_type)
 async def select_event_type(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-
     if message.text not in EVENT_TYPES:
         await message.answer("Пожалуйста, выберите тип события из списка:")
         return
@@ -653,27 +2585,17 @@ async def select_event_type(message: types.Message, state: FSMContext):
     )
     await state.set_state(AddScheduleEvent.description)
 
-@dp.message(AddScheduleEvent.description)
+@schedule_router.message(AddScheduleEvent.description)
 async def save_event(message: types.Message, state: FSMContext):
-    if message.text == "❌ Отмена":
-        await cancel_handler(message, state)
-        return
-
     data = await state.get_data()
     description = None if message.text == "/skip" else message.text
 
     # Сохраняем событие в БД
-    db = SessionLocal()
     try:
-        event = ScheduleEvent(
-            user_id=message.from_user.id,
-            subject=data['subject'],
-            event_type=data['event_type'],
-            event_date=data['date'],
-            description=description
-        )
-        db.add(event)
-        db.commit()
+        event = await write_user_db(_add_event, message.from_user.id, data['subject'], data['event_type'],
+                               data['date'], description)
+        await listing_cache.invalidate(message.from_user.id)
+        reminder_scheduler.add(event)
 
         await message.answer(
             f"✅ Событие добавлено!\n\n"
@@ -684,117 +2606,882 @@ async def save_event(message: types.Message, state: FSMContext):
             reply_markup=schedule_menu_kb()
         )
     except Exception as e:
-        db.rollback()
         await message.answer(
             "❌ Ошибка при сохранении события",
             reply_markup=schedule_menu_kb()
         )
         logging.error(f"Error saving event: {e}")
     finally:
-        db.close()
         await state.clear()
 
-@dp.message(F.text == "Мои события")
+@schedule_router.button("Мои события")
 async def show_events(message: types.Message):
-    db = SessionLocal()
     try:
-        # Берем события начиная с сегодняшнего дня
-        today = datetime.now().date()
-        events = db.query(ScheduleEvent) \
-            .filter(ScheduleEvent.user_id == message.from_user.id) \
-            .filter(ScheduleEvent.event_date >= today) \
-            .order_by(ScheduleEvent.event_date) \
-            .all()
-
-        if not events:
+        page = await event_page(message.from_user.id)
+        if not page:
             await message.answer("У вас нет запланированных событий")
             return
 
-        response = ["📅 Ваши ближайшие события:"]
-        for event in events:
-            response.append(
-                f"\n📌 {event.event_date.strftime('%d.%m.%Y')}\n"
-                f"📚 {event.subject} - {event.event_type}\n"
-                f"📄 {event.description if event.description else 'без описания'}"
-            )
-
-        # Разбиваем на несколько сообщений если слишком длинное
-        for i in range(0, len(response), 5):
-            await message.answer("\n".join(response[i:i + 5]))
+        text, keyboard = page
+        await message.answer(text, reply_markup=keyboard)
 
     except Exception as e:
         await message.answer("❌ Ошибка при получении событий")
         logging.error(f"Error getting events: {e}")
-    finally:
-        db.close()
 
-@dp.message(Command("db_check"))
-async def db_check(message: types.Message):
-    db = SessionLocal()
+@schedule_router.callback_query(F.data.startswith("ev_page_"))
+async def event_page_navigation(callback: types.CallbackQuery):
+    _, _, direction, value, row_id = callback.data.split("_")
+    page = await event_page(callback.from_user.id, direction, _decode_cursor(value, row_id))
+    if not page:
+        await callback.answer("Здесь больше ничего нет")
+        return
 
-    # Получаем статистику
-    hw_count = db.query(func.count(Homework.id)).filter(Homework.user_id == message.from_user.id).scalar()
-    events_count = db.query(func.count(ScheduleEvent.id)).filter(ScheduleEvent.user_id == message.from_user.id).scalar()
+    text, keyboard = page
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
-    # Получаем последние 3 записи
-    last_hw = db.query(Homework).filter(Homework.user_id == message.from_user.id) \
-        .order_by(Homework.created_at.desc()).limit(3).all()
-    last_events = db.query(ScheduleEvent).filter(ScheduleEvent.user_id == message.from_user.id) \
-        .order_by(ScheduleEvent.created_at.desc()).limit(3).all()
+# ===== Импорт расписания и заданий =====
+IMPORT_MAX_FILE_SIZE = 2 * 1024 * 1024  # Максимальный размер файла импорта в байтах
+IMPORT_MAX_ROWS = 5000  # Сколько записей можно загрузить одним файлом
+IMPORT_BATCH_SIZE = 500  # Сколько строк вставляется одной транзакцией
+IMPORT_MAX_ERRORS_SHOWN = 10
+
+IMPORT_HELP = (
+    "📥 Пришли файл .csv или .ics.\n\n"
+    "CSV (UTF-8, разделитель «,» или «;»), первая строка - заголовок:\n"
+    "тип,дата,предмет,вид,описание\n"
+    "событие,20.12.2025,Математика,Контрольная работа,Глава 3\n"
+    "задание,22.12.2025,Физика,,Упражнение 5\n\n"
+    "iCalendar: VEVENT становятся событиями, VTODO - заданиями. "
+    "Предмет и вид события ищутся в SUMMARY и CATEGORIES."
+)
+
+def _parse_import_date(value):
+    value = value.strip()
+    for date_format in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата «{value}»")
+
+def _match_choice(text, choices):
+    text = text.lower()
+    return next((choice for choice in choices if choice.lower() in text), None)
+
+def _iter_csv_records(stream):
+    """Читает CSV построчно и возвращает (номер строки, вид записи, поля) или (номер строки, None, ошибка)"""
+    header = stream.readline()
+    delimiter = ";" if header.count(";") > header.count(",") else ","
+    reader = csv.reader(stream, delimiter=delimiter)
+    for line_number, row in enumerate(reader, 2):
+        if not any(cell.strip() for cell in row):
+            continue
+        kind, date, subject, event_type, description = (row + [""] * 5)[:5]
+        kind = kind.strip().lower()
+        subject = subject.strip()
+        try:
+            if subject not in SUBJECTS:
+                raise ValueError(f"неизвестный предмет «{subject}»")
+            if kind == "событие":
+                if event_type.strip() not in EVENT_TYPES:
+                    raise ValueError(f"неизвестный вид события «{event_type.strip()}»")
+                yield line_number, "event", {
+                    "subject": subject,
+                    "event_type": event_type.strip(),
+                    "event_date": _parse_import_date(date),
+                    "description": description.strip()[:300] or None,
+                }
+            elif kind == "задание":
+                if not description.strip():
+                    raise ValueError("не указан текст задания")
+                yield line_number, "homework", {
+                    "subject": subject,
+                    "task": description.strip()[:500],
+                    "deadline": _parse_import_date(date) if date.strip() else None,
+                }
+            else:
+                raise ValueError(f"неизвестный тип записи «{kind}»")
+        except ValueError as e:
+            yield line_number, None, str(e)
+
+def _unescape_ics(value):
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+def _parse_ics_datetime(value):
+    value = value.strip()
+    if len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d")
+    parsed = datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        parsed = parsed.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    return parsed
+
+def _iter_ics_lines(stream):
+    """Склеивает свернутые строки iCalendar (продолжение начинается с пробела или табуляции)"""
+    current, current_number = None, 0
+    for line_number, line in enumerate(stream, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current_number, current
+        current, current_number = line, line_number
+    if current is not None:
+        yield current_number, current
+
+def _iter_ics_records(stream):
+    """Читает iCalendar построчно: VEVENT - события, VTODO - задания"""
+    component, properties, start_line = None, {}, 0
+    for line_number, line in _iter_ics_lines(stream):
+        name, _, value = line.partition(":")
+        name = name.split(";", 1)[0].upper()
+        if name == "BEGIN" and value.upper() in ("VEVENT", "VTODO"):
+            component, properties, start_line = value.upper(), {}, line_number
+        elif name == "END" and component and value.upper() == component:
+            summary = _unescape_ics(properties.get("SUMMARY", ""))
+            categories = _unescape_ics(properties.get("CATEGORIES", ""))
+            description = _unescape_ics(properties.get("DESCRIPTION", "")).strip()
+            subject = _match_choice(f"{categories} {summary}", SUBJECTS)
+            try:
+                if subject is None:
+                    raise ValueError(f"не найден предмет в «{summary}»")
+                if component == "VEVENT":
+                    event_type = _match_choice(f"{categories} {summary}", EVENT_TYPES)
+                    if event_type is None:
+                        raise ValueError(f"не найден вид события в «{summary}»")
+                    if "DTSTART" not in properties:
+                        raise ValueError("нет DTSTART")
+                    yield start_line, "event", {
+                        "subject": subject,
+                        "event_type": event_type,
+                        "event_date": _parse_ics_datetime(properties["DTSTART"]),
+                        "description": description[:300] or None,
+                    }
+                else:
+                    task = description or summary
+                    yield start_line, "homework", {
+                        "subject": subject,
+                        "task": task[:500],
+                        "deadline": _parse_ics_datetime(properties["DUE"]) if "DUE" in properties else None,
+                    }
+            except ValueError as e:
+                yield start_line, None, str(e)
+            component = None
+        elif component:
+            properties.setdefault(name, value)
+
+def _parse_import_file(data, filename, user_id):
+    """Разбирает файл импорта. Возвращает (задания, события, ошибки)"""
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    records = _iter_ics_records(stream) if filename.lower().endswith(".ics") else _iter_csv_records(stream)
+    homeworks, events, errors = [], [], []
+    for line_number, kind, fields in records:
+        if kind is None:
+            errors.append(f"строка {line_number}: {fields}")
+            continue
+        if len(homeworks) + len(events) >= IMPORT_MAX_ROWS:
+            errors.append(f"файл обрезан: загружаются только первые {IMPORT_MAX_ROWS} записей")
+            break
+        fields["user_id"] = user_id
+        (events if kind == "event" else homeworks).append(fields)
+    return homeworks, events, errors
+
+@transfer_router.message(Command("import"))
+async def import_start(message: types.Message, state: FSMContext):
+    await message.answer(IMPORT_HELP, reply_markup=cancel_kb())
+    await state.set_state(ImportData.waiting_for_file)
+
+@transfer_router.message(ImportData.waiting_for_file)
+async def import_file(message: types.Message, state: FSMContext):
+    document = message.document
+    if not document or not document.file_name or \
+            not document.file_name.lower().endswith((".csv", ".ics")):
+        await message.answer("Пожалуйста, пришли файл .csv или .ics")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer(f"❌ Файл слишком большой (максимум {IMPORT_MAX_FILE_SIZE // 1024 // 1024} МБ)")
+        return
+
+    try:
+        buffer = io.BytesIO()
+        await bot.download(document, destination=buffer)
+        homeworks, events, errors = await asyncio.to_thread(
+            _parse_import_file, buffer.getvalue(), document.file_name, message.from_user.id)
+
+        for model, rows in ((Homework, homeworks), (ScheduleEvent, events)):
+            for i in range(0, len(rows), IMPORT_BATCH_SIZE):
+                await user_shard(message.from_user.id).run(_insert_rows, model, rows[i:i + IMPORT_BATCH_SIZE])
+
+        await listing_cache.invalidate(message.from_user.id)
+        if events:
+            reminder_scheduler.rescan()
+
+        response = [f"✅ Импорт завершен: заданий - {len(homeworks)}, событий - {len(events)}"]
+        if errors:
+            response.append(f"\n⚠️ Пропущено записей с ошибками: {len(errors)}")
+            response += errors[:IMPORT_MAX_ERRORS_SHOWN]
+        await answer_packed(message, response, reply_markup=main_menu_kb())
+    except Exception as e:
+        await message.answer("❌ Ошибка при импорте файла", reply_markup=main_menu_kb())
+        logging.error(f"Error importing file: {e}")
+    finally:
+        await state.clear()
+
+# ===== Экспорт расписания и заданий =====
+EXPORT_SPOOL_SIZE = 1024 * 1024  # До какого размера файл экспорта собирается в памяти, дальше - на диске
+
+class SpooledInputFile(InputFile):
+    """Файл для отправки из временного файла: читается кусками, не загружаясь в память целиком"""
+
+    def __init__(self, file, filename, chunk_size=64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+def _escape_ics(value):
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _format_ics_date(value):
+    if value.hour == value.minute == value.second == 0:
+        return f";VALUE=DATE:{value.strftime('%Y%m%d')}"
+    return f":{value.strftime('%Y%m%dT%H%M%S')}"
+
+def _write_ics_line(out, line):
+    """Пишет строку iCalendar, сворачивая ее по 75 байт, как требует RFC 5545"""
+    chunk, size = "", 0
+    for char in line:
+        char_size = len(char.encode("utf-8"))
+        if size + char_size > 75:
+            out.write(chunk + "\r\n")
+            chunk, size = " ", 1
+        chunk += char
+        size += char_size
+    out.write(chunk + "\r\n")
+
+def _export_ics(db: Session, user_id, out):
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    _write_ics_line(out, "BEGIN:VCALENDAR")
+    _write_ics_line(out, "VERSION:2.0")
+    _write_ics_line(out, "PRODID:-//school-bot//RU")
+    for event in _iter_user_events(db, user_id):
+        _write_ics_line(out, "BEGIN:VEVENT")
+        _write_ics_line(out, f"UID:event-{event.id}@school-bot")
+        _write_ics_line(out, f"DTSTAMP:{stamp}")
+        _write_ics_line(out, f"DTSTART{_format_ics_date(event.event_date)}")
+        _write_ics_line(out, f"SUMMARY:{_escape_ics(f'{event.subject}: {event.event_type}')}")
+        _write_ics_line(out, f"CATEGORIES:{_escape_ics(event.subject)}")
+        if event.description:
+            _write_ics_line(out, f"DESCRIPTION:{_escape_ics(event.description)}")
+        _write_ics_line(out, "END:VEVENT")
+    for hw in _iter_user_homeworks(db, user_id):
+        _write_ics_line(out, "BEGIN:VTODO")
+        _write_ics_line(out, f"UID:homework-{hw.id}@school-bot")
+        _write_ics_line(out, f"DTSTAMP:{stamp}")
+        if hw.deadline:
+            _write_ics_line(out, f"DUE{_format_ics_date(hw.deadline)}")
+        _write_ics_line(out, f"SUMMARY:{_escape_ics(f'{hw.subject}: {hw.task[:50]}')}")
+        _write_ics_line(out, f"CATEGORIES:{_escape_ics(hw.subject)}")
+        _write_ics_line(out, f"DESCRIPTION:{_escape_ics(hw.task)}")
+        _write_ics_line(out, f"STATUS:{'COMPLETED' if hw.is_done else 'NEEDS-ACTION'}")
+        _write_ics_line(out, "END:VTODO")
+    _write_ics_line(out, "END:VCALENDAR")
+
+def _export_csv(db: Session, user_id, out):
+    # Формат совместим с /import, последняя колонка при импорте не читается
+    writer = csv.writer(out)
+    writer.writerow(["тип", "дата", "предмет", "вид", "описание", "выполнено"])
+    for event in _iter_user_events(db, user_id):
+        writer.writerow(["событие", event.event_date.strftime("%d.%m.%Y"), event.subject,
+                         event.event_type, event.description or "", ""])
+    for hw in _iter_user_homeworks(db, user_id):
+        writer.writerow(["задание", hw.deadline.strftime("%d.%m.%Y") if hw.deadline else "", hw.subject,
+                         "", hw.task, "да" if hw.is_done else "нет"])
+
+def _export_user_data(db: Session, user_id, export_format):
+    """Пишет события и задания пользователя во временный файл, читая БД пачками"""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    out = io.TextIOWrapper(spool, encoding="utf-8-sig" if export_format == "csv" else "utf-8", newline="")
+    try:
+        (_export_csv if export_format == "csv" else _export_ics)(db, user_id, out)
+        out.flush()
+        return out.detach()
+    except Exception:
+        out.close()
+        raise
+
+@transfer_router.message(Command("export"))
+async def export_data(message: types.Message, command: CommandObject):
+    export_format = (command.args or "ics").strip().lower()
+    if export_format not in ("ics", "csv"):
+        await message.answer("Используй /export или /export csv")
+        return
+
+    try:
+        spool = await run_user_db(_export_user_data, message.from_user.id, export_format)
+        try:
+            await message.answer_document(
+                SpooledInputFile(spool, f"school_bot_{datetime.now().strftime('%Y%m%d')}.{export_format}"),
+                caption="📤 Твои события и задания"
+            )
+        finally:
+            spool.close()
+    except Exception as e:
+        await message.answer("❌ Ошибка при экспорте")
+        logging.error(f"Error exporting data: {e}")
 
-    db.close()
+@main_router.message(Command("db_check"))
+async def db_check(message: types.Message):
+    # Получаем статистику и последние 3 записи
+    hw_count, events_count, last_hw, last_events = await run_user_db(_get_db_stats, message.from_user.id)
 
-    response = (
+    response = [
         f"📊 Статистика БД:\n"
         f"Домашних заданий: {hw_count}\n"
         f"Событий в расписании: {events_count}\n\n"
-        f"Последние задания:\n"
-    )
+        f"Последние задания:"
+    ]
 
     for hw in last_hw:
-        response += f"- {hw.subject}: {hw.task[:20]}... (до {hw.deadline.strftime('%d.%m.%Y') if hw.deadline else 'нет срока'})\n"
+        response.append(f"- {hw.subject}: {hw.task[:20]}... (до {hw.deadline.strftime('%d.%m.%Y') if hw.deadline else 'нет срока'})")
 
-    response += "\nПоследние события:\n"
+    response.append("\nПоследние события:")
     for event in last_events:
-        response += f"- {event.subject}: {event.event_type} ({event.event_date.strftime('%d.%m.%Y')})\n"
+        response.append(f"- {event.subject}: {event.event_type} ({event.event_date.strftime('%d.%m.%Y')})")
+
+    await answer_packed(message, response)
+
+PERF_TOP = 10  # Сколько самых затратных строк показывать в каждом разделе /perf
+
+def _perf_section(title, histogram, errors=None):
+    lines = [f"\n{title}:"]
+    # Сортируем по суммарному времени: наверху то, на что уходит больше всего ресурсов
+    labels = sorted(histogram.series, key=lambda label: histogram.series[label][-2], reverse=True)
+    for label in labels[:PERF_TOP]:
+        count, average, p95 = histogram.summary(label)
+        line = f"- {label}: {count} шт., среднее {average * 1000:.1f} мс, p95 ≤ {p95 * 1000:g} мс"
+        if errors and errors.values.get(label):
+            line += f", ошибок {errors.values[label]}"
+        lines.append(line)
+    if not labels:
+        lines.append("- нет данных")
+    return lines
+
+@main_router.message(Command("perf"))
+async def show_perf(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
 
-    await message.answer(response)
+    stats = outbound_queue.stats
+    response = [
+        f"⏱ Производительность:\n"
+        f"Очередь исходящих: {outbound_queue.queued()} в очереди, отправлено {stats['sent']}, "
+        f"ошибок {stats['failed']}, RetryAfter {stats['retry_after']}\n"
+        f"Напоминаний в очереди: {reminder_scheduler.queued()}, "
+        f"опоздание последнего {reminder_lag.values.get(None, 0):.1f} с, "
+        f"цикла {reminder_loop_lag.values.get(None, 0):.3f} с\n"
+        f"Ошибок в логе: {sum(logged_errors.values.values())}"
+    ]
+    response += _perf_section("Обработчики", handler_seconds, handler_errors)
+    response += _perf_section("Вызовы БД", db_call_seconds)
+    response += _perf_section("SQL-запросы", db_query_seconds)
+    response += _perf_section("Bot API", api_seconds, api_errors)
+    await answer_packed(message, response)
+
+# ===== Напоминания о событиях =====
+REMINDER_TIME = time(18, 0)  # Во сколько накануне события приходит напоминание
+REMINDER_LOAD_AHEAD = timedelta(days=2)  # На сколько вперед события подгружаются из БД
+REMINDER_RETRY_DELAY = 60  # Пауза в секундах, если БД недоступна
+REMINDER_SEND_RETRY_DELAY = 300  # Через сколько секунд повторить напоминание, которое не удалось отправить
+
+def reminder_time_for(event_date):
+    return datetime.combine(event_date.date() - timedelta(days=1), REMINDER_TIME)
+
+class ReminderScheduler:
+    """Очередь напоминаний, упорядоченная по времени отправки.
+
+    События подгружаются из БД окнами по REMINDER_LOAD_AHEAD, новые события
+    добавляются через add(). Отправка помечается в БД, поэтому каждое
+    напоминание уходит ровно один раз, в том числе после перезапуска. Если
+    отправить не удалось, отметка снимается и напоминание повторяется через
+    REMINDER_SEND_RETRY_DELAY.
+    """
+
+    def __init__(self, load_ahead=REMINDER_LOAD_AHEAD):
+        self.load_ahead = load_ahead
+        self._heap = []
+        self._queued = set()
+        self._loaded_until = None
+        self._wakeup = asyncio.Event()
+        self._sending = set()
+
+    def add(self, event):
+        """Ставит событие в очередь, если оно попадает в уже загруженное окно"""
+        if self._loaded_until is None or event.event_date > self._loaded_until:
+            return  # Событие будет загружено из БД позже
+        # id событий уникальны только внутри шарда, а пользователь живет в одном шарде
+        if event.reminder_sent_at is not None:
+            return
+        self._push(reminder_time_for(event.event_date), event.id, event.user_id,
+                   event.subject, event.event_type, event.event_date)
 
-async def check_upcoming_events():
+    def _push(self, remind_at, event_id, user_id, subject, event_type, event_date):
+        key = (user_id, event_id)
+        if key in self._queued:
+            return
+        heapq.heappush(self._heap, (remind_at, event_id, user_id, subject, event_type, event_date))
+        self._queued.add(key)
+        self._wakeup.set()
+
+    def queued(self):
+        return len(self._heap)
+
+    def rescan(self):
+        """Перечитывает окно напоминаний из БД, например после массового импорта событий"""
+        self._loaded_until = None
+        self._wakeup.set()
+
+    async def _load(self, now):
+        previous = self._loaded_until
+        until = now + self.load_ahead
+        # Окно сдвигаем до запроса, чтобы события, сохраненные во время него, попали в очередь через add()
+        self._loaded_until = until
+        try:
+            # Шарды просматриваются параллельно
+            shard_events = await run_all_shards(_get_pending_reminders, previous or now, until)
+        except Exception:
+            self._loaded_until = previous
+            raise
+        for events in shard_events:
+            for event in events:
+                self.add(event)
+
+    async def _fire(self, event_id, user_id, subject, event_type, event_date):
+        # Напоминания пропускают вперед ответы пользователям
+        send_priority.set(PRIORITY_BULK)
+        claimed_at = None
+        try:
+            # Пользователь, который получает ежедневную сводку, отдельных напоминаний не получает
+            if await run_db(_get_digest_time, user_id):
+                return
+            claimed_at = await write_user_db(_claim_reminder, user_id, event_id)
+            if claimed_at is None:
+                return
+            day = "Сегодня" if event_date.date() == datetime.now().date() else "Завтра"
+            await bot.send_message(user_id, f"📢 {day} {event_type} по {subject}! Время готовиться! 💪")
+        except Exception as e:
+            logging.error(f"Ошибка отправки напоминания: {e}")
+            await self._retry_later(event_id, user_id, subject, event_type, event_date, claimed_at)
+            return
+        try:
+            await send_random_motivation(user_id)
+        except Exception as e:
+            # Само напоминание уже доставлено, поэтому его не повторяем
+            logging.error(f"Ошибка отправки мотивации к напоминанию: {e}")
+
+    async def _retry_later(self, event_id, user_id, subject, event_type, event_date, claimed_at):
+        """Снимает отметку об отправке и ставит напоминание в очередь еще раз"""
+        if claimed_at is not None:
+            try:
+                if not await write_user_db(_release_reminder, user_id, event_id, claimed_at):
+                    return  # Событие удалили или изменили
+            except Exception as e:
+                logging.error(f"Не удалось снять отметку с напоминания {event_id}: {e}")
+                return
+        retry_at = datetime.now() + timedelta(seconds=REMINDER_SEND_RETRY_DELAY)
+        if retry_at < event_date:
+            self._push(retry_at, event_id, user_id, subject, event_type, event_date)
+
+    async def run(self):
+        # Event привязывается к циклу событий при первом ожидании, а run() может запускаться
+        # в новом цикле (например, между тестами). Очередь после создания Event все равно проверяется
+        self._wakeup = asyncio.Event()
+        while True:
+            now = datetime.now()
+            next_load = now + timedelta(seconds=REMINDER_RETRY_DELAY)
+            try:
+                if self._loaded_until is None or self._loaded_until - now < self.load_ahead / 2:
+                    await self._load(now)
+                next_load = self._loaded_until - self.load_ahead / 2
+            except Exception as e:
+                logging.error(f"Ошибка загрузки напоминаний: {e}")
+
+            while self._heap and self._heap[0][0] <= datetime.now():
+                remind_at, event_id, user_id, subject, event_type, event_date = heapq.heappop(self._heap)
+                self._queued.discard((user_id, event_id))
+                if event_date <= datetime.now():
+                    continue
+                reminder_lag.set((datetime.now() - remind_at).total_seconds())
+                # Отправка идет через очередь исходящих сообщений, поэтому напоминания не ждут друг друга
+                task = asyncio.create_task(self._fire(event_id, user_id, subject, event_type, event_date))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+
+            self._wakeup.clear()
+            wake_at = min(self._heap[0][0], next_load) if self._heap else next_load
+            timeout = max((wake_at - datetime.now()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                reminder_loop_lag.set(max((datetime.now() - wake_at).total_seconds(), 0))
+
+reminder_scheduler = ReminderScheduler()
+metric(Gauge("bot_reminders_queued", "Напоминаний в очереди планировщика", collect=reminder_scheduler.queued))
+
+# ===== Ежедневная сводка =====
+# Пользователь может вместо отдельных напоминаний о каждом событии получать в выбранное
+# время одно сообщение: события на завтра и задания со сроком до конца завтрашнего дня
+DIGEST_CHECK_INTERVAL = 60  # Как часто проверять, кому пора отправить сводку, в секундах
+DIGEST_MAX_ITEMS = 10  # Сколько событий и заданий показывать в сводке, остальные только считаются
+DIGEST_QUERY_USERS = 500  # Для скольких пользователей собирать сводки одним запросом
+
+digests_sent = metric(Counter("bot_digests_sent_total", "Отправленные ежедневные сводки"))
+
+def _set_digest_time(db: Session, user_id, digest_time):
+    settings = db.get(UserSettings, user_id)
+    if settings is None:
+        settings = UserSettings(user_id=user_id)
+        db.add(settings)
+    settings.digest_time = digest_time
+
+def _get_digest_time(db: Session, user_id):
+    settings = db.get(UserSettings, user_id)
+    return settings.digest_time if settings else None
+
+def _claim_digests(db: Session, now):
+    """Помечает сводки всех пользователей, которым пора, и возвращает их user_id"""
+    today = datetime.combine(now.date(), time())
+    db.query(UserSettings) \
+        .filter(UserSettings.digest_time.isnot(None)) \
+        .filter(UserSettings.digest_time <= now.strftime("%H:%M")) \
+        .filter(or_(UserSettings.digest_sent_at.is_(None), UserSettings.digest_sent_at < today)) \
+        .update({UserSettings.digest_sent_at: now}, synchronize_session=False)
+    # Строки, помеченные именно этим вызовом, отличаются по значению digest_sent_at
+    return [user_id for (user_id,) in db.query(UserSettings.user_id).filter(UserSettings.digest_sent_at == now)]
+
+def _get_digest_items(db: Session, user_ids, now):
+    """Собирает содержимое сводок пользователей user_ids одним запросом к шарду.
+
+    Возвращает {user_id: [(вид, дата, предмет, подробности), ...]}; пользователи без событий
+    и заданий в результат не попадают.
+    """
+    tomorrow = datetime.combine(now.date(), time()) + timedelta(days=1)
+    events = select(literal("event").label("kind"), ScheduleEvent.user_id.label("user_id"),
+                    ScheduleEvent.event_date.label("date"), ScheduleEvent.subject,
+                    ScheduleEvent.event_type.label("details")) \
+        .where(ScheduleEvent.user_id.in_(user_ids),
+               ScheduleEvent.event_date >= tomorrow, ScheduleEvent.event_date < tomorrow + timedelta(days=1))
+    homeworks = select(literal("homework"), Homework.user_id, Homework.deadline, Homework.subject, Homework.task) \
+        .where(Homework.user_id.in_(user_ids), Homework.is_done == False,
+               Homework.deadline < tomorrow + timedelta(days=1))
+    rows = db.execute(union_all(events, homeworks).order_by("user_id", "kind", "date")).all()
+
+    return {user_id: [(row.kind, row.date, row.subject, row.details) for row in user_rows]
+            for user_id, user_rows in itertools.groupby(rows, key=lambda row: row.user_id)}
+
+def _format_digest_items(title, lines):
+    if not lines:
+        return []
+    response = [f"\n{title}"] + lines[:DIGEST_MAX_ITEMS]
+    if len(lines) > DIGEST_MAX_ITEMS:
+        response.append(f"...и еще {len(lines) - DIGEST_MAX_ITEMS}")
+    return response
+
+def format_digest(items, now):
+    tomorrow = now.date() + timedelta(days=1)
+    events, homeworks = [], []
+    for kind, date, subject, details in items:
+        if kind == "event":
+            events.append(f"- {subject}: {details}")
+        else:
+            short = f"{details[:50]}{'...' if len(details) > 50 else ''}"
+            if date.date() < now.date():
+                homeworks.append(f"- ⚠️ {subject}: {short} (просрочено, до {date.strftime('%d.%m.%Y')})")
+            else:
+                day = "сегодня" if date.date() == now.date() else "завтра"
+                homeworks.append(f"- {subject}: {short} (до {day})")
+
+    response = [f"🗓 Сводка на завтра, {tomorrow.strftime('%d.%m.%Y')}"]
+    response += _format_digest_items("📢 События:", events)
+    response += _format_digest_items("📚 Задания:", homeworks)
+    return "\n".join(response)
+
+async def _send_digest(user_id, text):
+    try:
+        await bot.send_message(user_id, text)
+        digests_sent.inc()
+    except Exception as e:
+        logging.error(f"Ошибка отправки сводки: {e}")
+
+async def send_digests():
+    now = datetime.now()
+    by_shard = {}
+    for user_id in await run_db(_claim_digests, now):
+        by_shard.setdefault(user_shard(user_id), []).append(user_id)
+    # Содержимое сводок собирается во всех шардах параллельно, пачками по DIGEST_QUERY_USERS пользователей
+    results = await asyncio.gather(*(shard.run(_get_digest_items, user_ids[i:i + DIGEST_QUERY_USERS], now)
+                                     for shard, user_ids in by_shard.items()
+                                     for i in range(0, len(user_ids), DIGEST_QUERY_USERS)))
+    digests = {user_id: items for result in results for user_id, items in result.items()}
+    # Сводки идут через очередь исходящих сообщений и пропускают вперед ответы пользователям
+    send_priority.set(PRIORITY_BULK)
+    await asyncio.gather(*(_send_digest(user_id, format_digest(items, now)) for user_id, items in digests.items()))
+
+async def run_digests():
     while True:
-        db = SessionLocal()
         try:
-            tomorrow = datetime.now() + timedelta(days=1)
-            events = db.query(ScheduleEvent) \
-                .filter(ScheduleEvent.event_date >= datetime.now()) \
-                .filter(ScheduleEvent.event_date <= tomorrow) \
-                .all()
+            await send_digests()
+        except Exception as e:
+            logging.error(f"Ошибка подготовки сводок: {e}")
+        # Просыпаемся в начале следующей минуты
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL - datetime.now().second % DIGEST_CHECK_INTERVAL)
 
-            for event in events:
-                await bot.send_message(
-                    event.user_id,
-                    f"📢 Завтра {event.event_type} по {event.subject}! Время готовиться! 💪"
-                )
-                # Имитируем сообщение для вызова send_motivation
-                fake_message = types.Message(
-                    chat=types.Chat(id=event.user_id),
-                    from_user=types.User(id=event.user_id)
-                )
-                await send_motivation(fake_message)
+@main_router.message(Command("digest"))
+async def digest_settings(message: types.Message, command: CommandObject):
+    argument = (command.args or "").strip().lower()
+    try:
+        if not argument:
+            digest_time = await run_db(_get_digest_time, message.from_user.id)
+            if digest_time:
+                await message.answer(f"🗓 Сводка приходит каждый день в {digest_time}.\n"
+                                     f"Изменить время: /digest ЧЧ:ММ, выключить: /digest off")
+            else:
+                await message.answer("🗓 Сводка выключена, напоминания приходят о каждом событии отдельно.\n"
+                                     "Включить: /digest ЧЧ:ММ, например /digest 19:00")
+            return
+
+        if argument == "off":
+            await write_db(_set_digest_time, message.from_user.id, None)
+            await message.answer("Сводка выключена, напоминания снова будут приходить о каждом событии.")
+            return
 
+        try:
+            digest_time = datetime.strptime(argument, "%H:%M").strftime("%H:%M")
+        except ValueError:
+            await message.answer("Неверный формат времени! Используй ЧЧ:ММ, например /digest 19:00")
+            return
+        await write_db(_set_digest_time, message.from_user.id, digest_time)
+        await message.answer(f"✅ Каждый день в {digest_time} я пришлю одну сводку: события на завтра "
+                             f"и задания, срок которых подходит или уже прошел.")
+    except Exception as e:
+        await message.answer("❌ Ошибка при сохранении настроек")
+        logging.error(f"Error saving digest settings: {e}")
+
+# ===== Архивирование старых записей =====
+# Выполненные задания и прошедшие события переносятся в таблицы *_archive, чтобы горячие
+# таблицы и их индексы оставались маленькими. Сроки хранения задаются в днях
+ARCHIVE_HOMEWORK_AFTER = timedelta(days=int(os.getenv("ARCHIVE_HOMEWORK_AFTER_DAYS", "30")))  # После срока задания
+ARCHIVE_EVENTS_AFTER = timedelta(days=int(os.getenv("ARCHIVE_EVENTS_AFTER_DAYS", "7")))  # После даты события
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", str(6 * 60 * 60)))  # Как часто запускать, в секундах
+ARCHIVE_BATCH_SIZE = 500  # Записей в одной транзакции
+ARCHIVE_BATCH_PAUSE = 0.05  # Пауза между транзакциями, чтобы не задерживать запись пользователей
+ARCHIVE_VACUUM_PAGES = 1000  # Сколько свободных страниц возвращать системе за один шаг
+
+archived_rows = metric(Counter("bot_archived_rows_total", "Записей, перенесенных в архив", "table"))
+
+def _move_to_archive(db: Session, model, archive_model, condition, batch_size):
+    """Переносит до batch_size записей model, подходящих под condition, в archive_model"""
+    # Запись с наибольшим id не трогаем: иначе SQLite может выдать ее id новой записи,
+    # и он совпадет с id в архиве
+    newest_id = db.query(func.max(model.id)).scalar_subquery()
+    ids = [row_id for (row_id,) in db.query(model.id).filter(condition).filter(model.id < newest_id)
+           .limit(batch_size).all()]
+    if not ids:
+        return 0
+
+    columns = [column.name for column in model.__table__.columns]
+    rows = select(*model.__table__.columns, literal(datetime.now())).where(model.id.in_(ids))
+    # Обычный INSERT: при совпадении id вся пачка откатывается с ошибкой, и запись не удаляется без архивации
+    db.execute(insert(archive_model).from_select(columns + ["archived_at"], rows))
+    db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+def _archive_homeworks(db: Session, cutoff, batch_size):
+    condition = and_(Homework.is_done == True, func.coalesce(Homework.deadline, Homework.created_at) < cutoff)
+    return _move_to_archive(db, Homework, HomeworkArchive, condition, batch_size)
+
+def _archive_events(db: Session, cutoff, batch_size):
+    return _move_to_archive(db, ScheduleEvent, ScheduleEventArchive, ScheduleEvent.event_date < cutoff, batch_size)
+
+def _incremental_vacuum(db: Session, pages):
+    """Возвращает системе до pages свободных страниц файла БД и сообщает, сколько вернул"""
+    free_before = db.execute(text("PRAGMA freelist_count")).scalar()
+    # Модуль sqlite3 выполняет PRAGMA через execute() только на один шаг (одну страницу),
+    # executescript() выполняет ее до конца
+    db.connection().connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return free_before - db.execute(text("PRAGMA freelist_count")).scalar()
+
+async def _archive_shard(shard, now):
+    for table, archive, cutoff in (("homeworks", _archive_homeworks, now - ARCHIVE_HOMEWORK_AFTER),
+                                   ("schedule_events", _archive_events, now - ARCHIVE_EVENTS_AFTER)):
+        while True:
+            moved = await shard.run(archive, cutoff, ARCHIVE_BATCH_SIZE)
+            archived_rows.inc(table, moved)
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+    while await shard.run(_incremental_vacuum, ARCHIVE_VACUUM_PAGES) >= ARCHIVE_VACUUM_PAGES:
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+async def archive_old_records():
+    """Переносит старые записи в архив небольшими транзакциями и сжимает файлы БД"""
+    now = datetime.now()
+    # У шардов разные блокировки записи, поэтому они архивируются параллельно
+    await asyncio.gather(*(_archive_shard(shard, now) for shard in shards))
+    if len(shards) > 1:
+        # В основной БД архивировать нечего, но удаленные состояния диалогов тоже оставляют свободные страницы
+        while await run_db(_incremental_vacuum, ARCHIVE_VACUUM_PAGES) >= ARCHIVE_VACUUM_PAGES:
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+async def run_archiving():
+    while True:
+        try:
+            await archive_old_records()
         except Exception as e:
-            logging.error(f"Ошибка проверки событий: {e}")
-        finally:
-            db.close()
-            await asyncio.sleep(3600)  # Проверка каждый час
+            logging.error(f"Ошибка архивирования: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+# ===== Сборка приложения =====
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "2"))  # За сколько секунд бот должен подняться
+
+startup_seconds = metric(Gauge("bot_startup_seconds", "Длительность этапов запуска", "phase"))
+
+@contextmanager
+def startup_phase(name):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        startup_seconds.set(perf_counter() - started, name)
+
+def check_startup_budget():
+    """Пишет в лог, сколько занял запуск, и предупреждает, если больше STARTUP_BUDGET"""
+    phases = startup_seconds.values
+    total = sum(phases.values())
+    details = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in phases.items())
+    if total > STARTUP_BUDGET:
+        logging.warning(f"Запуск занял {total:.2f} с, это больше бюджета {STARTUP_BUDGET:g} с: {details}")
+    else:
+        logging.info(f"Запуск занял {total:.2f} с: {details}")
+
+def create_bot(token):
+    session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+    new_bot = Bot(token=token, session=session)
+    new_bot.session.middleware(outbound_queue)
+    new_bot.session.middleware(ApiMetricsMiddleware())
+    return new_bot
+
+def create_app(token=None, db_url=None, db_shards=None):
+    """Подключается к БД и ее шардам (применяя миграции) и создает бота.
+
+    По умолчанию настройки берутся из переменных окружения BOT_TOKEN, DB_URL и DB_SHARDS.
+    Возвращает бота; диспетчер - dp.
+    """
+    global bot, engine, shards
+    token = token or BOT_TOKEN
+    if not token:
+        raise RuntimeError("Не задан токен бота: укажи его в переменной окружения BOT_TOKEN")
+
+    logging.getLogger().addHandler(error_log_counter)
+    with startup_phase("db"):
+        db_url = db_url or DB_URL
+        db_shards = db_shards or DB_SHARDS
+        engine = create_db_engine(db_url)
+        instrument_engine(engine)
+        run_migrations(engine)
+        SessionLocal.configure(bind=engine)
+        check_shard_layout(db_url, db_shards)
+        shards = open_shards(db_url, db_shards)
+    with startup_phase("bot"):
+        bot = create_bot(token)
+    return bot
 
 async def on_startup():
-    asyncio.create_task(check_upcoming_events())
+    with startup_phase("motivation_scan"):
+        motivation_catalog.scan()
+    if Image is None and media_pipeline.workers > 0:
+        logging.warning("Pillow не установлен (pip install pillow): картинки мотивации сохраняются без обработки")
+    # Картинки, загруженные до появления обработки или не попавшие в заполненную очередь
+    asyncio.create_task(media_pipeline.backfill(MOTIVATION_IMG_DIR))
+    asyncio.create_task(reminder_scheduler.run())
+    asyncio.create_task(run_digests())
+    asyncio.create_task(run_archiving())
+    check_startup_budget()
+
+async def on_shutdown():
+    media_pipeline.close()
+    await dp.storage.close()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# ===== Режим работы: polling или webhook =====
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")  # Адрес, на котором слушает сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Внешний адрес (https://...), который сообщается Telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Значение заголовка X-Telegram-Bot-Api-Secret-Token
+
+async def metrics_endpoint(request):
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise web.HTTPUnauthorized()
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-cache"})
+
+def create_webhook_app():
+    """aiohttp-приложение, принимающее обновления от Telegram на WEBHOOK_PATH"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def start_metrics_server():
+    """Отдельный сервер с METRICS_PATH на METRICS_HOST:METRICS_PORT"""
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на {METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    return runner
+
+async def run_webhook():
+    if not WEBHOOK_SECRET:
+        logging.warning("WEBHOOK_SECRET не задан: запросы к webhook не проверяются")
+    if WEBHOOK_URL:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              drop_pending_updates=True)
+
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
-    dp.startup.register(on_startup)
+    logging.basicConfig(level=logging.INFO)
+    create_app()
     asyncio.run(main())
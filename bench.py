@@ -0,0 +1,258 @@
+"""Нагрузочный тест бота без сети.
+
+Синтетические пользователи проходят основные сценарии (добавление задания и
+события, "Мои задания", навигация по календарю, отметка выполнения) через
+настоящий диспетчер dp.feed_update. Bot API подменяется фиктивной сессией
+с теми же middleware, что у настоящей (очередь исходящих и метрики), база
+данных создается во временной папке. В конце печатается пропускная
+способность и задержки обработчиков (p50/p95/p99).
+
+Лимиты Telegram на частоту отправки по умолчанию сняты, иначе почти все время
+ушло бы на паузы между сообщениями в один чат; --telegram-limits их включает.
+
+    python bench.py --users 50 --rounds 5
+    python bench.py --users 50 --rounds 5 --shards 4
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API, которая отвечает сразу (или с задержкой latency) и запоминает клавиатуры"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.last_markup = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = getattr(method, "chat_id", None)
+        markup = getattr(method, "reply_markup", None)
+        if chat_id is not None and isinstance(markup, types.InlineKeyboardMarkup):
+            self.last_markup[chat_id] = markup
+        if method.__returning__ is types.Message:
+            return types.Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=types.Chat(id=chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class SyntheticUser:
+    """Пользователь, который отправляет обновления в диспетчер так же, как Telegram"""
+
+    def __init__(self, bench, user_id):
+        self.bench = bench
+        self.user_id = user_id
+        self.user = types.User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+        self.chat = types.Chat(id=user_id, type="private")
+
+    async def send(self, text):
+        update = types.Update(
+            update_id=next(self.bench.update_ids),
+            message=types.Message(
+                message_id=next(self.bench.update_ids),
+                date=datetime.now(),
+                chat=self.chat,
+                from_user=self.user,
+                text=text,
+            ),
+        )
+        await self.bench.feed(update)
+
+    async def press(self, callback_data):
+        update = types.Update(
+            update_id=next(self.bench.update_ids),
+            callback_query=types.CallbackQuery(
+                id=str(next(self.bench.update_ids)),
+                chat_instance=str(self.user_id),
+                from_user=self.user,
+                data=callback_data,
+                message=types.Message(
+                    message_id=1,
+                    date=datetime.now(),
+                    chat=self.chat,
+                    text="...",
+                    reply_markup=self.bench.session.last_markup.get(self.user_id),
+                ),
+            ),
+        )
+        await self.bench.feed(update)
+
+    def inline_buttons(self, prefix):
+        markup = self.bench.session.last_markup.get(self.user_id)
+        if not markup:
+            return []
+        return [button.callback_data for row in markup.inline_keyboard for button in row
+                if button.callback_data and button.callback_data.startswith(prefix)]
+
+    async def add_homework(self, rng):
+        deadline = datetime.now() + timedelta(days=rng.randint(-3, 30))
+        for text in ("📚 Домашние задания", "Добавить задание", rng.choice(self.bench.bot_module.SUBJECTS),
+                     deadline.strftime("%d.%m.%Y"), f"Упражнение {rng.randint(1, 500)}"):
+            await self.send(text)
+
+    async def add_event(self, rng):
+        date = datetime.now() + timedelta(days=rng.randint(0, 60))
+        for text in ("📅 Расписание", "Добавить событие", date.strftime("%d.%m.%Y"),
+                     rng.choice(self.bench.bot_module.SUBJECTS), rng.choice(self.bench.bot_module.EVENT_TYPES),
+                     "/skip"):
+            await self.send(text)
+
+    async def browse_homeworks(self, rng):
+        await self.send("Мои задания")
+        for callback_data in self.inline_buttons("hw_page_")[:1]:
+            await self.press(callback_data)
+
+    async def browse_calendar(self, rng):
+        await self.send("Календарь")
+        for _ in range(rng.randint(1, 4)):
+            navigation = self.inline_buttons("calendar_nav_")
+            if navigation:
+                await self.press(rng.choice(navigation))
+
+    async def mark_done(self, rng):
+        await self.send("Отметить выполнение")
+        done_buttons = self.inline_buttons("hw_done_")
+        if done_buttons:
+            await self.press(rng.choice(done_buttons))
+
+    async def run(self, rounds, seed):
+        rng = random.Random(seed)
+        flows = [self.add_homework, self.add_event, self.browse_homeworks, self.browse_calendar, self.mark_done]
+        for _ in range(rounds):
+            for flow in rng.sample(flows, len(flows)):
+                await flow(rng)
+
+
+class Benchmark:
+    def __init__(self, bot_module, latency, telegram_limits):
+        self.bot_module = bot_module
+        self.session = FakeSession(latency)
+        self.update_ids = itertools.count(1)
+        self.update_latencies = []
+        self.handler_latencies = defaultdict(list)
+        self.errors = 0
+
+        # Те же middleware, что create_bot() подключает к настоящей сессии
+        if telegram_limits:
+            self.outbound_queue = bot_module.outbound_queue
+        else:
+            self.outbound_queue = bot_module.OutboundQueue(global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+        self.session.middleware(self.outbound_queue)
+        self.session.middleware(bot_module.ApiMetricsMiddleware())
+        bot_module.bot.session = self.session
+        # Время обработчиков меряется внутренним middleware: в него попадают только сработавшие обработчики
+        bot_module.dp.message.middleware(self._measure_handler)
+        bot_module.dp.callback_query.middleware(self._measure_handler)
+
+    async def _measure_handler(self, handler, event, data):
+        started = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.handler_latencies[self.bot_module.handler_name(data)].append(perf_counter() - started)
+
+    async def feed(self, update):
+        started = perf_counter()
+        try:
+            await self.bot_module.dp.feed_update(self.bot_module.bot, update)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Ошибка обработки обновления: {e}")
+        self.update_latencies.append(perf_counter() - started)
+
+    async def run(self, users, rounds, seed):
+        started = perf_counter()
+        await asyncio.gather(*(SyntheticUser(self, 1000 + i).run(rounds, seed + i) for i in range(users)))
+        elapsed = perf_counter() - started
+        await self.bot_module.dp.storage.close()
+        return elapsed
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def format_row(name, values):
+    return (f"{name:<34}{len(values):>8}"
+            + "".join(f"{percentile(values, p) * 1000:>10.2f}" for p in (50, 95, 99)))
+
+
+def report(bench, elapsed):
+    updates = len(bench.update_latencies)
+    print(f"Обновлений: {updates}, ошибок: {bench.errors}, время: {elapsed:.2f} с, "
+          f"пропускная способность: {updates / elapsed:.1f} обновлений/с")
+    print(f"Вызовов Bot API: {sum(bench.session.calls.values())} "
+          f"({', '.join(f'{name}: {count}' for name, count in sorted(bench.session.calls.items()))})")
+    print(f"Очередь исходящих: {bench.outbound_queue.stats}")
+    print()
+    print(f"{'Обработчик':<34}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, values in sorted(bench.handler_latencies.items()):
+        print(format_row(name, values))
+    print(format_row("* обновление целиком", bench.update_latencies))
+
+
+def load_bot_module(workdir, shards):
+    """Импортирует бота и собирает приложение так, что БД и папки с мотивацией находятся во временной папке"""
+    os.environ["DB_URL"] = f"sqlite:///{workdir}/school_bot.db"
+    os.environ["MOTIVATION_DIR"] = os.path.join(workdir, "motivational_content")
+    sys.path.insert(0, BOT_DIR)
+    import KOsten114
+    KOsten114.create_app(token="123456:BENCHMARK", db_shards=shards)
+    return KOsten114
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота без сети")
+    parser.add_argument("--users", type=int, default=50, help="сколько пользователей работают одновременно")
+    parser.add_argument("--rounds", type=int, default=5, help="сколько раз каждый проходит все сценарии")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API в мс")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="соблюдать лимиты Telegram на частоту отправки (1 сообщение в секунду в чат)")
+    parser.add_argument("--shards", type=int, default=1, help="на сколько файлов разложить задания и события")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as workdir:
+        bot_module = load_bot_module(workdir, args.shards)
+        bench = Benchmark(bot_module, args.api_latency / 1000, args.telegram_limits)
+        elapsed = asyncio.run(bench.run(args.users, args.rounds, args.seed))
+        report(bench, elapsed)
+        for shard in bot_module.shards:
+            shard.engine.dispose()
+        bot_module.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Перенос заданий и событий между шардами БД.
+
+Переносит homeworks, schedule_events и их архивы из основной БД и файлов шардов
+с другим числом шардов в DB_SHARDS новых файлов, раскладывая пользователей по хэшу
+user_id так же, как бот. Бот на время переноса нужно остановить, а после запустить
+с тем же DB_SHARDS.
+
+id записей сохраняются, если свободны в новом шарде: иначе запись получает новый id.
+Пачки сначала фиксируются в новом шарде и только потом удаляются из старого, поэтому
+прерванный перенос можно просто запустить еще раз.
+
+    python reshard.py --shards 4
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import func, insert
+from sqlalchemy.engine import make_url
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BOT_DIR)
+import KOsten114 as bot_module  # noqa: E402
+
+FAMILIES = (
+    (bot_module.Homework, bot_module.HomeworkArchive),
+    (bot_module.ScheduleEvent, bot_module.ScheduleEventArchive),
+)
+BATCH_SIZE = 1000
+
+
+def row_values(row, model):
+    return {column.name: getattr(row, column.name) for column in model.__table__.columns}
+
+
+def find_copy(db, model, row):
+    """Та же запись под другим id: ее уже перенес прерванный запуск, выдав новый id"""
+    criteria = [getattr(model, name).is_(None) if value is None else getattr(model, name) == value
+                for name, value in row.items() if name != "id"]
+    return db.query(model.id).filter(*criteria).first()
+
+
+def copy_rows(db, model, family, rows):
+    """Вставляет rows в model, сохраняя id, если он не занят ни в одной таблице семейства (горячей и архиве)"""
+    ids = [row["id"] for row in rows]
+    taken = {}
+    for table in family:
+        for existing in db.query(table).filter(table.id.in_(ids)):
+            taken[existing.id] = existing
+
+    next_id = None
+    new_rows = []
+    for row in rows:
+        existing = taken.get(row["id"])
+        if existing is not None:
+            if isinstance(existing, model) and row_values(existing, model) == row or find_copy(db, model, row):
+                continue  # Уже перенесена прерванным запуском
+            if next_id is None:
+                newest = max((db.query(func.max(table.id)).scalar() or 0 for table in family), default=0)
+                next_id = max(newest, *ids) + 1
+            row = dict(row, id=next_id)
+            next_id += 1
+        new_rows.append(row)
+    if new_rows:
+        db.execute(insert(model), new_rows)
+    return len(new_rows)
+
+
+def move_table(source, targets, model, family):
+    """Переносит все строки model из source в шарды targets пачками по BATCH_SIZE"""
+    moved = 0
+    while True:
+        db = source.sessions()
+        try:
+            rows = [row_values(row, model) for row in
+                    db.query(model).order_by(model.id).limit(BATCH_SIZE).all()]
+        finally:
+            db.close()
+        if not rows:
+            return moved
+
+        by_target = {}
+        for row in rows:
+            by_target.setdefault(bot_module.shard_index(row["user_id"], len(targets)), []).append(row)
+        for index, target_rows in by_target.items():
+            db = targets[index].sessions()
+            try:
+                copy_rows(db, model, family, target_rows)
+                db.commit()
+            finally:
+                db.close()
+
+        db = source.sessions()
+        try:
+            db.query(model).filter(model.id.in_([row["id"] for row in rows])).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        moved += len(rows)
+
+
+def restore_newest_id(db, model, archive_model):
+    """Возвращает в горячую таблицу архивную запись с наибольшим id, если он больше горячих.
+
+    SQLite выдает новой записи id на единицу больше наибольшего в таблице, и без этого
+    он мог бы совпасть с id в архиве (см. _move_to_archive в боте).
+    """
+    newest_id = db.query(func.max(model.id)).scalar() or 0
+    newest = db.query(archive_model).filter(archive_model.id > newest_id) \
+        .order_by(archive_model.id.desc()).first()
+    if newest is not None:
+        db.execute(insert(model), [row_values(newest, model)])
+        db.delete(newest)
+
+
+def remove_database_files(url):
+    path = make_url(url).database
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос заданий и событий между шардами БД")
+    parser.add_argument("--shards", type=int, required=True, help="сколько шардов должно стать")
+    parser.add_argument("--db-url", default=bot_module.DB_URL, help="основная БД (по умолчанию DB_URL)")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards должно быть не меньше 1")
+
+    target_urls = bot_module.shard_urls(args.db_url, args.shards)
+    source_urls = [args.db_url] if args.shards > 1 else []
+    source_urls += [f"sqlite:///{path}" for path in bot_module.find_stale_shards(args.db_url, args.shards)]
+
+    targets = [bot_module.connect_shard(index, url) for index, url in enumerate(target_urls)]
+    for url in source_urls:
+        source = bot_module.connect_shard(0, url)
+        for model, archive_model in FAMILIES:
+            for table in (model, archive_model):
+                moved = move_table(source, targets, table, (model, archive_model))
+                print(f"{url}: {table.__tablename__} - перенесено {moved}")
+        source.engine.dispose()
+        if url != args.db_url:
+            remove_database_files(url)
+
+    for target in targets:
+        db = target.sessions()
+        try:
+            for model, archive_model in FAMILIES:
+                restore_newest_id(db, model, archive_model)
+            db.commit()
+            counts = ", ".join(f"{model.__tablename__} {db.query(func.count(model.id)).scalar()}"
+                               for model in bot_module.SHARDED_MODELS)
+        finally:
+            db.close()
+        target.engine.dispose()
+        print(f"Шард {target.index}: {counts}")
+
+    print(f"Готово. Запускай бота с DB_SHARDS={args.shards}")
+
+
+if __name__ == "__main__":
+    main()